@@ -0,0 +1,507 @@
+'''Client delivery benchmark
+
+Runs client/dispatch-query.py as a subprocess against local stand-ins:
+
+    - a fake dispatch server serving a synthetic backlog through /claim-dispatch
+      and recording /confirm-dispatch, /report-dispatch-failed and /defer-dispatch
+    - a minimal SMTP sink (AUTH accepted, no TLS, the client runs with SMTP_STARTTLS=false)
+    - a fake ntfy server (topic API and push) with configurable latency and 429s
+
+and reports messages/s, enqueue => delivery and enqueue => confirm latency
+and the number of connections each stand-in saw.
+
+    python3 benchmarks/client_delivery.py --messages 2000
+    python3 benchmarks/client_delivery.py --ntfy-latency-ms 50 --ntfy-429-rate 0.05
+
+The fake dispatch server answers 404 once everything was confirmed or failed,
+which ends the client's loop. Client settings (NTFY_CONCURRENCY, CLAIM_LIMIT,
+...) are taken from the environment as usual.
+'''
+
+import argparse
+import base64
+import collections
+import http.server
+import json
+import os
+import random
+import re
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+CLIENT = os.path.join(BENCHMARK_DIR, "..", "client", "dispatch-query.py")
+
+DISPATCH_TOKEN = "benchmark"
+UUID_PATTERN = re.compile(r"bench-([0-9a-f]{32})")
+
+def percentile(values, p):
+
+    if not values:
+        return 0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+class Counter:
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self):
+        with self._lock:
+            self.value += 1
+
+class Deliveries:
+    '''First time a stand-in saw a message, by dispatch uuid'''
+
+    def __init__(self):
+        self.at = {}
+        self._lock = threading.Lock()
+
+    def record(self, text):
+
+        match = UUID_PATTERN.search(text or "")
+        if not match:
+            return
+
+        with self._lock:
+            self.at.setdefault(match.group(1), time.time())
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    '''Keep-alive JSON handler counting its connections'''
+
+    protocol_version = "HTTP/1.1"
+
+    # headers and body go out in separate writes, don't let them wait for delayed ACKs #
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connections.inc()
+
+    def log_message(self, *args):
+        pass
+
+    def read_json(self):
+
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"null")
+
+    def reply(self, status, body=None, headers={}):
+
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def query(self):
+        return dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+
+def serve_http(handler, state):
+    '''Start a threaded HTTP server on a free port, returns it'''
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    server.connections = Counter()
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class Backlog:
+    '''State of the fake dispatch server'''
+
+    def __init__(self, messages, email_share, users, lease_seconds):
+
+        self.total = messages
+        self.email_share = email_share
+        self.users = users
+        self.lease_seconds = lease_seconds
+
+        self.entries = collections.OrderedDict() # uuid => dispatch #
+        self.not_before = {}
+        self.leased_until = {}
+        self.enqueued_at = {}
+        self.confirmed_at = {}
+        self.failed = {}
+        self.deferrals = 0
+        self.created = 0
+
+        self.condition = threading.Condition()
+
+    def add(self, count):
+
+        with self.condition:
+            for _ in range(count):
+
+                if self.created >= self.total:
+                    break
+
+                dispatch_uuid = uuid.uuid4().hex
+                username = "user{}".format(self.created % self.users)
+                self.entries[dispatch_uuid] = {
+                    "uuid" : dispatch_uuid,
+                    "username" : username,
+                    "person" : username,
+                    "email" : "{}@example.org".format(username),
+                    "phone" : "0",
+                    "method" : "email" if random.random() < self.email_share else "ntfy",
+                    "title" : "Benchmark {}".format(self.created),
+                    "message" : "benchmark message bench-{}".format(dispatch_uuid),
+                    "link" : None,
+                    "error" : None,
+                    "attempts" : 0,
+                    "timestamp" : time.time(),
+                }
+                self.enqueued_at[dispatch_uuid] = time.time()
+                self.created += 1
+
+            self.condition.notify_all()
+
+    def finished(self):
+        return self.created >= self.total and not self.entries
+
+    def claim(self, methods, limit, wait):
+        '''Lease up to <limit> dispatches, None once the whole backlog is done'''
+
+        deadline = time.time() + wait
+        with self.condition:
+            while True:
+
+                if self.finished():
+                    return None
+
+                now = time.time()
+                claimed = []
+                for dispatch_uuid, entry in self.entries.items():
+                    if len(claimed) >= limit:
+                        break
+                    if entry["method"] not in methods:
+                        continue
+                    if self.leased_until.get(dispatch_uuid, 0) > now:
+                        continue
+                    if self.not_before.get(dispatch_uuid, 0) > now:
+                        continue
+                    self.leased_until[dispatch_uuid] = now + self.lease_seconds
+                    claimed.append(entry)
+
+                if claimed or now >= deadline:
+                    return claimed
+
+                # deferred dispatches become due without a notify #
+                self.condition.wait(min(deadline - now, 0.05))
+
+    def _settle(self, uuids, record):
+
+        results = {}
+        with self.condition:
+            for dispatch_uuid in uuids:
+                if self.entries.pop(dispatch_uuid, None):
+                    record(dispatch_uuid)
+                    self.leased_until.pop(dispatch_uuid, None)
+                    results[dispatch_uuid] = "confirmed"
+                else:
+                    results[dispatch_uuid] = "not-found"
+            self.condition.notify_all()
+
+        return results
+
+    def confirm(self, uuids):
+        return self._settle(uuids, lambda u: self.confirmed_at.__setitem__(u, time.time()))
+
+    def fail(self, errors):
+        return self._settle(errors.keys(), lambda u: self.failed.__setitem__(u, errors[u]))
+
+    def defer(self, deferrals):
+
+        with self.condition:
+            for dispatch_uuid, seconds in deferrals.items():
+                if dispatch_uuid in self.entries:
+                    self.not_before[dispatch_uuid] = time.time() + seconds
+                    self.leased_until.pop(dispatch_uuid, None)
+                    self.deferrals += 1
+            self.condition.notify_all()
+
+        return { u : "deferred" for u in deferrals }
+
+class DispatchHandler(Handler):
+
+    def do_POST(self):
+
+        backlog = self.server.state
+        location = urllib.parse.urlparse(self.path).path
+
+        if location == "/claim-dispatch":
+            args = self.query()
+            claimed = backlog.claim(args.get("method", "").split(","), int(args.get("limit") or 100),
+                            float(args.get("wait") or 0))
+            if claimed is None:
+                self.reply(404, "No dispatches left")
+            else:
+                self.reply(200, claimed)
+        elif location == "/confirm-dispatch":
+            self.reply(200, backlog.confirm([ c["uuid"] for c in self.read_json() ]))
+        elif location == "/report-dispatch-failed":
+            self.reply(200, backlog.fail({ r["uuid"] : r["error"] for r in self.read_json() }))
+        elif location == "/defer-dispatch":
+            self.reply(200, backlog.defer({ d["uuid"] : d["seconds"] for d in self.read_json() }))
+        else:
+            self.reply(404)
+
+class NtfyState:
+
+    def __init__(self, latency, rate_429, retry_after):
+
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+
+        self.deliveries = Deliveries()
+        self.topic_lookups = Counter()
+        self.pushes = Counter()
+        self.rejected = Counter()
+
+class NtfyHandler(Handler):
+
+    def do_GET(self):
+
+        state = self.server.state
+        if urllib.parse.urlparse(self.path).path != "/topic":
+            return self.reply(404)
+
+        state.topic_lookups.inc()
+        self.reply(200, { "topic" : "bench-topic-{}".format(self.query().get("user")) })
+
+    def do_POST(self):
+
+        state = self.server.state
+        payload = self.read_json()
+        state.pushes.inc()
+
+        if state.latency:
+            time.sleep(state.latency)
+
+        if random.random() < state.rate_429:
+            state.rejected.inc()
+            return self.reply(429, { "error" : "limit reached" },
+                                headers={ "Retry-After" : str(state.retry_after) })
+
+        state.deliveries.record(payload.get("message"))
+        self.reply(200, { "id" : uuid.uuid4().hex, "topic" : payload.get("topic") })
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    '''Just enough ESMTP for smtplib: EHLO, AUTH PLAIN/LOGIN, MAIL, RCPT, DATA, QUIT'''
+
+    disable_nagle_algorithm = True
+
+    def send(self, line):
+        self.wfile.write((line + "\r\n").encode())
+
+    def readline(self):
+        '''Next line without line ending, None once the client hung up'''
+
+        line = self.rfile.readline()
+        if not line:
+            return None
+        return line.decode("utf-8", "replace").rstrip("\r\n")
+
+    def handle(self):
+
+        state = self.server.state
+        state.connections.inc()
+
+        self.send("220 benchmark ESMTP sink")
+        while True:
+
+            line = self.readline()
+            if line is None:
+                return
+
+            command = line.split(" ")[0].upper()
+            if command == "EHLO":
+                self.send("250-benchmark")
+                self.send("250 AUTH PLAIN LOGIN")
+            elif command == "HELO":
+                self.send("250 benchmark")
+            elif command == "AUTH":
+                parts = line.split(" ")
+                if parts[1].upper() == "LOGIN":
+                    self.send("334 " + base64.b64encode(b"Username:").decode())
+                    self.readline()
+                    self.send("334 " + base64.b64encode(b"Password:").decode())
+                    self.readline()
+                elif len(parts) < 3:
+                    self.send("334 ")
+                    self.readline()
+                self.send("235 Authentication successful")
+            elif command in ("MAIL", "RCPT", "RSET", "NOOP"):
+                self.send("250 OK")
+            elif command == "DATA":
+                self.send("354 End data with <CR><LF>.<CR><LF>")
+                body = []
+                while True:
+                    data_line = self.readline()
+                    if data_line is None:
+                        return
+                    if data_line == ".":
+                        break
+                    body.append(data_line)
+                if state.latency:
+                    time.sleep(state.latency)
+                state.messages.inc()
+                state.deliveries.record("\n".join(body))
+                self.send("250 OK queued")
+            elif command == "QUIT":
+                self.send("221 Bye")
+                return
+            else:
+                self.send("502 Command not implemented")
+
+class SMTPState:
+
+    def __init__(self, latency):
+
+        self.latency = latency
+        self.deliveries = Deliveries()
+        self.connections = Counter()
+        self.messages = Counter()
+
+def serve_smtp(state):
+
+    class Server(socketserver.ThreadingTCPServer):
+        allow_reuse_address = True
+        daemon_threads = True
+
+    server = Server(("127.0.0.1", 0), SMTPSinkHandler)
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def feed(backlog, rate):
+    '''Add dispatches at <rate> per second until the backlog is complete'''
+
+    started = time.time()
+    while backlog.created < backlog.total:
+        due = int((time.time() - started) * rate) - backlog.created
+        if due > 0:
+            backlog.add(due)
+        time.sleep(0.01)
+
+def latency_summary(enqueued_at, reached_at):
+
+    latencies = [ reached_at[u] - enqueued_at[u] for u in reached_at if u in enqueued_at ]
+    return {
+        "count" : len(latencies),
+        "p50_ms" : round(percentile(latencies, 50) * 1000, 1),
+        "p99_ms" : round(percentile(latencies, 99) * 1000, 1),
+    }
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the dispatch client against local stand-ins',
+                        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--feed-rate', type=float, default=0,
+                            help='Dispatches added per second, 0 enqueues the whole backlog up front')
+    parser.add_argument('--email-share', type=float, default=0.5, help='Fraction sent by email')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--ntfy-latency-ms', type=float, default=5)
+    parser.add_argument('--ntfy-429-rate', type=float, default=0, help='Fraction of pushes answered with 429')
+    parser.add_argument('--ntfy-retry-after', type=int, default=1)
+    parser.add_argument('--smtp-latency-ms', type=float, default=5)
+    parser.add_argument('--client-rate-limit', action='store_true',
+                            help="Keep the client's ntfy rate limit instead of disabling it")
+    parser.add_argument('--timeout', type=int, default=600, help='Give up after this many seconds')
+    parser.add_argument('--client-log', help='Write the client output to this file')
+    parser.add_argument('--json', help='Also write the results to this file')
+
+    args = parser.parse_args()
+
+    backlog = Backlog(args.messages, args.email_share, args.users, lease_seconds=300)
+    ntfy = NtfyState(args.ntfy_latency_ms / 1000, args.ntfy_429_rate, args.ntfy_retry_after)
+    smtp = SMTPState(args.smtp_latency_ms / 1000)
+
+    dispatch_server = serve_http(DispatchHandler, backlog)
+    ntfy_server = serve_http(NtfyHandler, ntfy)
+    smtp_server = serve_smtp(smtp)
+
+    dispatch_url = "http://127.0.0.1:{}".format(dispatch_server.server_address[1])
+    ntfy_url = "http://127.0.0.1:{}".format(ntfy_server.server_address[1])
+
+    env = dict(os.environ,
+                DISPATCH_SERVER=dispatch_url,
+                DISPATCH_ACCESS_TOKEN=DISPATCH_TOKEN,
+                NTFY_API_SERVER=ntfy_url,
+                NTFY_API_TOKEN="benchmark",
+                NTFY_PUSH_TARGET=ntfy_url + "/",
+                NTFY_USER="benchmark",
+                NTFY_PASS="benchmark",
+                SMTP_TARGET="127.0.0.1",
+                SMTP_PORT=str(smtp_server.server_address[1]),
+                SMTP_USER="benchmark@example.org",
+                SMTP_PASS="benchmark",
+                SMTP_STARTTLS="false")
+    env.setdefault("LONG_POLL_SECONDS", "5")
+    env.setdefault("POLLING_INTERVAL_SECONDS", "1")
+
+    # measure the client, not the ntfy.sh default limits #
+    if not args.client_rate_limit:
+        env.setdefault("NTFY_RATE_LIMIT_BURST", "1000000")
+        env.setdefault("NTFY_RATE_LIMIT_REPLENISH_SECONDS", "0.000001")
+
+    if args.feed_rate:
+        threading.Thread(target=feed, args=(backlog, args.feed_rate), daemon=True).start()
+    else:
+        backlog.add(args.messages)
+
+    log = open(args.client_log, "w") if args.client_log else subprocess.DEVNULL
+
+    started = time.time()
+    client = subprocess.Popen([sys.executable, CLIENT], env=env, stdout=log, stderr=log)
+    try:
+        returncode = client.wait(timeout=args.timeout)
+    except subprocess.TimeoutExpired:
+        client.kill()
+        returncode = "timeout"
+    elapsed = time.time() - started
+
+    delivered_at = dict(ntfy.deliveries.at, **smtp.deliveries.at)
+    last_confirm = max(backlog.confirmed_at.values(), default=started)
+
+    results = {
+        "client_exit" : returncode,
+        "messages" : args.messages,
+        "confirmed" : len(backlog.confirmed_at),
+        "failed" : len(backlog.failed),
+        "unfinished" : len(backlog.entries) + backlog.total - backlog.created,
+        "seconds" : round(elapsed, 2),
+        "messages_per_second" : round(len(backlog.confirmed_at) / max(last_confirm - started, 1e-9), 1),
+        "delivery_latency" : latency_summary(backlog.enqueued_at, delivered_at),
+        "confirm_latency" : latency_summary(backlog.enqueued_at, backlog.confirmed_at),
+        "deferrals" : backlog.deferrals,
+        "ntfy_429" : ntfy.rejected.value,
+        "ntfy_pushes" : ntfy.pushes.value,
+        "ntfy_topic_lookups" : ntfy.topic_lookups.value,
+        "connections" : {
+            "dispatch" : dispatch_server.connections.value,
+            "ntfy" : ntfy_server.connections.value,
+            "smtp" : smtp.connections.value,
+        },
+    }
+
+    print(json.dumps(results, indent=2))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
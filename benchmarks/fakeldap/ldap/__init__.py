@@ -0,0 +1,153 @@
+'''In-process stand-in for python-ldap, just enough for server/ldaptools.py
+
+Put the fakeldap directory in front of sys.path and fill the directory with
+populate(). Searches are evaluated against the in-memory entries, LATENCY
+seconds are added to every search to simulate a network round trip.
+'''
+
+import re
+import threading
+import time
+
+SCOPE_BASE = 0
+SCOPE_ONELEVEL = 1
+SCOPE_SUBTREE = 2
+
+OPT_NETWORK_TIMEOUT = 0x5005
+OPT_TIMEOUT = 0x5002
+
+LATENCY = 0
+
+class LDAPError(Exception):
+    pass
+
+class SERVER_DOWN(LDAPError):
+    pass
+
+class TIMEOUT(LDAPError):
+    pass
+
+# dn => attributes (str => [bytes]) #
+ENTRIES = {}
+
+STATS = { "binds" : 0, "searches" : 0 }
+_stats_lock = threading.Lock()
+
+def populate(users, groups, people_dn="ou=People,dc=example,dc=org",
+                groups_dn="ou=groups,dc=example,dc=org", timestamp="20240101000000Z"):
+    '''Replace the directory with <users> (uid list) and <groups> ({cn: [uids]})'''
+
+    ENTRIES.clear()
+
+    for uid in users:
+        ENTRIES["uid={},{}".format(uid, people_dn)] = {
+            "objectClass" : [b"inetOrgPerson"],
+            "uid" : [uid.encode()],
+            "firstName" : [uid.encode()],
+            "mail" : ["{}@example.org".format(uid).encode()],
+            "telephoneNumber" : [b"0"],
+            "modifyTimestamp" : [timestamp.encode()],
+        }
+
+    for cn, members in groups.items():
+        ENTRIES["cn={},{}".format(cn, groups_dn)] = {
+            "objectClass" : [b"groupOfNames"],
+            "cn" : [cn.encode()],
+            "member" : [ "uid={},{}".format(uid, people_dn).encode() for uid in members ],
+            "modifyTimestamp" : [timestamp.encode()],
+        }
+
+def reset_stats():
+
+    with _stats_lock:
+        STATS["binds"] = 0
+        STATS["searches"] = 0
+
+def _count(name):
+
+    with _stats_lock:
+        STATS[name] += 1
+
+def _unescape(value):
+    return re.sub(r"\\([0-9a-fA-F]{2})", lambda m: chr(int(m.group(1), 16)), value)
+
+def _compile(search_filter):
+    '''Parse an RFC 4515 filter (&, |, !, =, >=, presence) into a predicate'''
+
+    pos = 0
+
+    def node():
+
+        nonlocal pos
+        if search_filter[pos] != "(":
+            raise LDAPError("Bad filter {}".format(search_filter))
+        pos += 1
+
+        op = search_filter[pos]
+        if op in "&|!":
+            pos += 1
+            children = []
+            while search_filter[pos] == "(":
+                children.append(node())
+            pos += 1
+            if op == "&":
+                return lambda entry: all(c(entry) for c in children)
+            elif op == "|":
+                return lambda entry: any(c(entry) for c in children)
+            else:
+                return lambda entry: not children[0](entry)
+
+        end = search_filter.index(")", pos)
+        item = search_filter[pos:end]
+        pos = end + 1
+
+        match = re.match(r"([^=<>]+)(>=|=)(.*)", item)
+        if not match:
+            raise LDAPError("Bad filter item {}".format(item))
+        attribute, operator, value = match.groups()
+        value = _unescape(value)
+
+        def predicate(entry):
+            values = [ v.decode() for v in entry.get(attribute, []) ]
+            if operator == ">=":
+                return any(v >= value for v in values)
+            if value == "*":
+                return bool(values)
+            return value in values
+
+        return predicate
+
+    return node()
+
+class _Connection:
+
+    def set_option(self, option, value):
+        pass
+
+    def simple_bind_s(self, who, cred):
+        _count("binds")
+
+    def unbind_s(self):
+        pass
+
+    def search_s(self, base, scope, filterstr="(objectClass=*)", attrlist=None):
+
+        _count("searches")
+        if LATENCY:
+            time.sleep(LATENCY)
+
+        predicate = _compile(filterstr)
+        results = []
+        for dn, entry in list(ENTRIES.items()):
+            if not dn.endswith(base) or not predicate(entry):
+                continue
+            if attrlist == ["1.1"]:
+                entry = {}
+            elif attrlist:
+                entry = { a : entry[a] for a in attrlist if a in entry }
+            results.append((dn, entry))
+
+        return results
+
+def initialize(uri):
+    return _Connection()
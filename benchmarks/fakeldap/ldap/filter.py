@@ -0,0 +1,7 @@
+def escape_filter_chars(assertion_value, escape_mode=0):
+
+    escaped = assertion_value.replace("\\", "\\5c")
+    for char, replacement in (("*", "\\2a"), ("(", "\\28"), (")", "\\29"), ("\x00", "\\00")):
+        escaped = escaped.replace(char, replacement)
+
+    return escaped
@@ -8,14 +8,54 @@ import os
 import requests
 import re
 import smtphelper
+import metrics
+import topiccache
+import ratelimit
+import email.utils
 import json
 import datetime
+import socket
+import threading
+import concurrent.futures
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 HTTP_NOT_FOUND = 404
+HTTP_TOO_MANY_REQUESTS = 429
 
 DISPATCH_SERVER = None
 DISPATCH_ACCESS_TOKEN = None
 
+# keep-alive sessions per upstream, set up in main #
+DISPATCH_HTTP = None
+DISPATCH_REPORT_HTTP = None
+NTFY_API_HTTP = None
+NTFY_PUSH_HTTP = None
+
+# username => ntfy topic, set up in main #
+TOPIC_CACHE = None
+
+# ntfy push rate limit, set up in main #
+NTFY_RATE_LIMIT = None
+NTFY_MAX_RATE_LIMIT_WAIT = 1
+NTFY_DEFAULT_RETRY_AFTER = 60
+
+# acknowledgements are buffered and sent in batches once per cycle #
+PENDING_CONFIRMS = []
+PENDING_FAILURES = []
+PENDING_DEFERRALS = []
+PENDING_LOCK = threading.Lock()
+ACK_FLUSH_INTERVAL = 1
+
+def make_http_session(pool_size, retry):
+    '''Session with a connection pool of <pool_size> and the given urllib3 retry policy'''
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
 def debug_send(uuid, data, fail_it=False):
     '''Dummy function to print and ack a dispatch for debugging'''
 
@@ -26,9 +66,8 @@ def debug_send(uuid, data, fail_it=False):
         confirm_dispatch(uuid)
 
 
-def email_send(dispatch_uuid, email_address, message, smtp_target,
-                smtp_target_port, smtp_user, smtp_pass):
-    '''Send message via email'''
+def email_send(dispatch_uuid, email_address, message, smtp_sessions):
+    '''Send message via email over a pooled SMTP session'''
 
     if not email_address:
         print("Missing E-Mail Address for STMP send", file=sys.stderr)
@@ -36,28 +75,38 @@ def email_send(dispatch_uuid, email_address, message, smtp_target,
         return
 
     subject = "Atlantis Dispatch"
-    smtphelper.smtp_send(smtp_target, smtp_target_port, smtp_user, smtp_pass, email_address,
-                            subject, message)
+    smtp_sessions.send(email_address, subject, message)
     confirm_dispatch(dispatch_uuid)
 
-def ntfy_api_get_topic(ntfy_api_server, ntfy_api_token, username):
-    '''Get the topic of the user'''
+def ntfy_api_get_topic(ntfy_api_server, ntfy_api_token, username, timeout=None):
+    '''Get the topic of the user, cached'''
+
+    found, topic = TOPIC_CACHE.get(username)
+    if found:
+        return topic
 
     params = {
         "user" : username,
         "token" : ntfy_api_token,
     }
 
-    r = requests.get(ntfy_api_server + "/topic", params=params)
-    if r.status_code != 200:
+    r = NTFY_API_HTTP.get(ntfy_api_server + "/topic", params=params, timeout=timeout)
+    if r.status_code == HTTP_NOT_FOUND:
+        print(r.text)
+        TOPIC_CACHE.set(username, None)
+        return None
+    elif r.status_code != 200:
+        # don't cache server errors #
         print(r.text)
         return None
     else:
         print(r.text)
-        return r.json().get("topic")
+        topic = r.json().get("topic")
+        TOPIC_CACHE.set(username, topic)
+        return topic
 
 def ntfy_send(dispatch_uuid, user_topic, title, message, link,
-                ntfy_push_target, ntfy_user, ntfy_pass):
+                ntfy_push_target, ntfy_user, ntfy_pass, timeout=None):
     '''Send message via NTFY topic'''
 
     # check message for links #
@@ -78,9 +127,14 @@ def ntfy_send(dispatch_uuid, user_topic, title, message, link,
         report_failed_dispatch(dispatch_uuid, "No user topic")
         return
 
-    try:
-
+    # wait briefly for a token, otherwise hand the message back for later #
+    granted, wait = NTFY_RATE_LIMIT.acquire(max_wait=NTFY_MAX_RATE_LIMIT_WAIT)
+    if not granted:
+        defer_dispatch(dispatch_uuid, NTFY_RATE_LIMIT.defer_delay())
+        return
+    time.sleep(wait)
 
+    try:
 
         # build message #
         payload = {
@@ -95,10 +149,14 @@ def ntfy_send(dispatch_uuid, user_topic, title, message, link,
         }
 
         # send #
-        r = requests.post(ntfy_push_target, auth=(ntfy_user, ntfy_pass), json=payload)
+        r = NTFY_PUSH_HTTP.post(ntfy_push_target, auth=(ntfy_user, ntfy_pass), json=payload,
+                            timeout=timeout)
         print(r.status_code, r.text, payload)
-        if r.status_code == 429: # rate-limit
-            time.sleep(60)
+        if r.status_code == HTTP_TOO_MANY_REQUESTS:
+            retry_after = _retry_after_seconds(r)
+            NTFY_RATE_LIMIT.pause(retry_after)
+            defer_dispatch(dispatch_uuid, NTFY_RATE_LIMIT.defer_delay())
+            return
 
         r.raise_for_status()
 
@@ -109,27 +167,188 @@ def ntfy_send(dispatch_uuid, user_topic, title, message, link,
         report_failed_dispatch(dispatch_uuid, str(e))
     except requests.exceptions.ConnectionError as e:
         report_failed_dispatch(dispatch_uuid, str(e))
+    except requests.exceptions.Timeout as e:
+        report_failed_dispatch(dispatch_uuid, str(e))
+    except requests.exceptions.RetryError as e:
+        report_failed_dispatch(dispatch_uuid, str(e))
 
-def report_failed_dispatch(uuid, error):
-    '''Inform the server that the dispatch has failed'''
+def _retry_after_seconds(response):
+    '''Parse Retry-After (seconds or HTTP date) with a fallback'''
 
-    payload = [{ "uuid" : uuid, "error" : error }]
-    response = requests.post(DISPATCH_SERVER + "/report-dispatch-failed", json=payload)
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return NTFY_DEFAULT_RETRY_AFTER
 
-    if response.status_code not in [200, 204]:
-        print("Failed to report back failed dispatch for {} ({})".format(
-                    uuid, response.text), file=sys.stderr)
+    try:
+        return max(0, float(retry_after))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+        now = datetime.datetime.now(retry_at.tzinfo)
+        return max(0, (retry_at - now).total_seconds())
+    except (TypeError, ValueError):
+        return NTFY_DEFAULT_RETRY_AFTER
+
+def defer_dispatch(uuid, seconds):
+    '''Queue handing the dispatch back to the server, to be claimed again after <seconds>'''
+
+    metrics.set_outcome("deferred")
+    with PENDING_LOCK:
+        PENDING_DEFERRALS.append({ "uuid" : uuid, "seconds" : seconds })
+
+def report_failed_dispatch(uuid, error):
+    '''Queue reporting to the server that the dispatch has failed'''
+
+    metrics.set_outcome("failed")
+    with PENDING_LOCK:
+        PENDING_FAILURES.append({ "uuid" : uuid, "error" : error })
 
 def confirm_dispatch(uuid):
-    '''Confirm to server that message has been dispatched and can be removed'''
+    '''Queue confirming to server that message has been dispatched and can be removed'''
 
-    payload = [{ "uuid" : uuid }]
-    response = requests.post(DISPATCH_SERVER + "/confirm-dispatch", json=payload)
+    metrics.set_outcome("confirmed")
+    with PENDING_LOCK:
+        PENDING_CONFIRMS.append({ "uuid" : uuid })
+
+def _post_acknowledgements(location, payload, http=None):
+
+    if not payload:
+        return
+
+    try:
+        response = (http or DISPATCH_HTTP).post(DISPATCH_SERVER + location, json=payload)
+    except requests.exceptions.RequestException as e:
+        print("Failed to send {} for {} dispatches ({})".format(location, len(payload), e),
+                    file=sys.stderr)
+        return
 
     if response.status_code not in [200, 204]:
-        print("Failed to confirm dispatch with server for {} ({})".format(
-                    uuid, response.text), file=sys.stderr)
+        print("Failed to send {} for {} dispatches ({})".format(
+                    location, len(payload), response.text), file=sys.stderr)
+        return
+
+    for uuid, status in response.json().items():
+        if status == "not-found":
+            print("{}: no pending dispatch for {}".format(location, uuid), file=sys.stderr)
+
+def flush_acknowledgements():
+    '''Send all buffered confirmations, failure reports and deferrals, one request each'''
+
+    with PENDING_LOCK:
+        confirms = PENDING_CONFIRMS[:]
+        failures = PENDING_FAILURES[:]
+        deferrals = PENDING_DEFERRALS[:]
+        del PENDING_CONFIRMS[:]
+        del PENDING_FAILURES[:]
+        del PENDING_DEFERRALS[:]
+
+    _post_acknowledgements("/confirm-dispatch", confirms)
+    _post_acknowledgements("/report-dispatch-failed", failures, DISPATCH_REPORT_HTTP)
+    _post_acknowledgements("/defer-dispatch", deferrals)
+
+
+class DeliveryChannel:
+    '''Claims dispatches for some methods and delivers them with a bounded worker pool'''
+
+    def __init__(self, name, methods, deliver, concurrency, rate_limit=None):
 
+        self.name = name
+        self.methods = methods
+        self.deliver = deliver
+        self.concurrency = concurrency
+        self.rate_limit = rate_limit
+
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency,
+                                thread_name_prefix=name)
+
+    def _free_slots(self):
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.in_flight < self.concurrency)
+            return self.concurrency - self.in_flight
+
+    def _deliver(self, entry):
+
+        metrics.start_delivery()
+        started = time.monotonic()
+        try:
+            self.deliver(entry)
+        except Exception:
+            metrics.observe_delivery(self.name, time.monotonic() - started, crashed=True)
+            raise
+
+        metrics.observe_delivery(self.name, time.monotonic() - started)
+
+    def _done(self, entry):
+
+        def callback(future):
+
+            error = future.exception()
+            if error:
+                print("{} delivery crashed: {}".format(self.name, error), file=sys.stderr)
+                report_failed_dispatch(entry["uuid"], str(error))
+
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+        return callback
+
+    def run(self, claim, claim_limit, long_poll, polling_interval, loop=True):
+        '''Claim as many dispatches as there are free workers and hand them to the pool'''
+
+        backlog_remaining = False
+        while True:
+
+            limit = min(self._free_slots(), claim_limit)
+
+            # don't claim what can't be sent yet, only to hand it back right away #
+            if self.rate_limit:
+                available, wait = self.rate_limit.peek()
+                if not available:
+                    time.sleep(wait)
+                    continue
+                limit = min(limit, available)
+
+            # don't wait if the last claim was full #
+            claim_started = time.monotonic()
+            try:
+                entries = claim(self.methods, limit, 0 if backlog_remaining else long_poll)
+            except requests.exceptions.RequestException as e:
+                print("{}: claiming dispatches failed ({})".format(self.name, e), file=sys.stderr)
+                time.sleep(polling_interval)
+                continue
+
+            if entries is None:
+                break
+
+            backlog_remaining = len(entries) >= limit
+            for entry in entries:
+
+                print(f"Sending: {entry['method']} {hash(str(entry.get('title')))} "
+                      f"@ {datetime.datetime.now()}", file=sys.stderr)
+
+                with self.condition:
+                    self.in_flight += 1
+                self.executor.submit(self._deliver, entry).add_done_callback(self._done(entry))
+
+            # handle non-loop runs, but still drain the backlog #
+            if not loop and not backlog_remaining:
+                break
+
+            # wait a moment, unless the server already did the waiting #
+            if not long_poll and not backlog_remaining:
+                time.sleep(polling_interval)
+
+            # server had no long-poll slot free and answered right away #
+            elif long_poll and not entries and time.monotonic() - claim_started < polling_interval:
+                time.sleep(polling_interval)
+
+        self.executor.shutdown(wait=True)
 
 if __name__ == "__main__":
 
@@ -152,6 +371,7 @@ if __name__ == "__main__":
     parser.add_argument('--smtp-port', type=int)
 
     parser.add_argument('--loop', default=True, action=argparse.BooleanOptionalAction)
+    parser.add_argument('--worker-id', help='Unique id of this worker for claiming dispatches')
 
     args = parser.parse_args()
 
@@ -177,63 +397,125 @@ if __name__ == "__main__":
 
     polling_interval = int(os.environ.get("POLLING_INTERVAL_SECONDS") or 5)
 
-    first_run = True
-    while args.loop or first_run:
-
-        # request dispatches #
-        response = requests.get(dispatch_server +
-            "/get-dispatch?method=all&timeout=0&dispatch-access-token={}".format(DISPATCH_ACCESS_TOKEN))
-
-        # check status #
-        if response.status_code == HTTP_NOT_FOUND:
-            sys.exit(0)
-
-        # fallback check for status #
-        response.raise_for_status()
-
-        # track dispatches that were confirmed to avoid duplicate confirmation #
-        dispatch_confirmed = []
+    # dispatches are leased to this worker, so several workers can run in parallel #
+    worker_id = args.worker_id or os.environ.get("WORKER_ID") or "{}-{}".format(
+                    socket.gethostname(), os.getpid())
+    lease_seconds = int(os.environ.get("LEASE_SECONDS") or 300)
 
-        # track failed dispatches #
-        errors = dict()
+    # page through large backlogs oldest-first in bounded chunks #
+    claim_limit = int(os.environ.get("CLAIM_LIMIT") or 100)
 
-        # iterate over dispatch requests #
-        for entry in response.json():
+    # let the server hold the request until something is enqueued (0 to disable) #
+    long_poll = int(os.environ.get("LONG_POLL_SECONDS") or 30)
+    if not args.loop:
+        long_poll = 0
 
-            user = entry["username"]
-            dispatch_uuid = entry["uuid"]
-            method = entry["method"]
-            message = entry["message"]
-            title = entry.get("title")
-            link = entry.get("link")
+    # upper bound for a single delivery (connect, send, response) #
+    message_timeout = int(os.environ.get("MESSAGE_TIMEOUT_SECONDS") or 30)
 
-            # method dependent fields #
-            phone = entry.get("phone")
-            email_address = entry.get("email")
+    def claim(methods, limit, wait):
 
-            # send message #
-            print(f"Sending: {method} {hash(str(title))} @ {datetime.datetime.now()}",
-                    file=sys.stderr)
-            if method == "signal":
-                pass
-            elif method == "ntfy":
-                user_topic = ntfy_api_get_topic(ntfy_api_server, ntfy_api_token, user)
-                ntfy_send(dispatch_uuid, user_topic, title, message, link,
-                                ntfy_push_target, ntfy_user, ntfy_pass)
-            elif method == "email":
-                email_send(dispatch_uuid, email_address, message, smtp_target,
-                                smtp_port, smtp_user, smtp_pass)
-            elif method == "debug":
-                debug_send(dispatch_uuid, entry)
-            elif method == "debug-fail":
-                debug_send(dispatch_uuid, entry, fail_it=True)
-            else:
-                print("Unsupported dispatch method {}".format(entry["method"]), sys=sys.stderr)
-                continue
+        params = {
+            "method" : ",".join(methods),
+            "timeout" : 0,
+            "wait" : wait,
+            "limit" : limit,
+            "worker" : worker_id,
+            "lease" : lease_seconds,
+            "dispatch-access-token" : DISPATCH_ACCESS_TOKEN,
+        }
+        response = DISPATCH_HTTP.post(dispatch_server + "/claim-dispatch", params=params,
+                        timeout=wait + 30)
 
-        # wait a moment #
-        if args.loop:
-            time.sleep(polling_interval)
+        # check status #
+        if response.status_code == HTTP_NOT_FOUND:
+            return None
 
-        # handle non-loop runs #
-        first_run = False
+        # fallback check for status #
+        response.raise_for_status()
+        return response.json()
+
+    def deliver_ntfy(entry):
+        user_topic = ntfy_api_get_topic(ntfy_api_server, ntfy_api_token, entry["username"],
+                            timeout=message_timeout)
+        ntfy_send(entry["uuid"], user_topic, entry.get("title"), entry["message"],
+                        entry.get("link"), ntfy_push_target, ntfy_user, ntfy_pass,
+                        timeout=message_timeout)
+
+    def deliver_email(entry):
+        email_send(entry["uuid"], entry.get("email"), entry["message"], smtp_sessions)
+
+    def deliver_debug(entry):
+        debug_send(entry["uuid"], entry, fail_it=entry["method"] == "debug-fail")
+
+    ntfy_concurrency = int(os.environ.get("NTFY_CONCURRENCY") or 4)
+    email_concurrency = int(os.environ.get("EMAIL_CONCURRENCY") or 2)
+    debug_concurrency = int(os.environ.get("DEBUG_CONCURRENCY") or 1)
+
+    # dispatch server: one long-poll per channel plus acks, confirms, deferrals & claims may be retried #
+    DISPATCH_HTTP = make_http_session(4, Retry(total=3, backoff_factor=0.5, allowed_methods=None,
+                            status_forcelist=[502, 503, 504]))
+
+    # every failure report counts an attempt, only retry reports that never reached the server #
+    DISPATCH_REPORT_HTTP = make_http_session(1, Retry(total=3, connect=3, read=False,
+                            status=0, other=0, backoff_factor=0.5, allowed_methods=None))
+
+    # ntfy topic lookups are idempotent GETs, don't sleep out a 429 in a delivery worker #
+    NTFY_API_HTTP = make_http_session(ntfy_concurrency, Retry(total=2, backoff_factor=0.2,
+                            status_forcelist=[502, 503, 504], respect_retry_after_header=False))
+
+    # only retry pushes that never reached the server, never send a notification twice, #
+    # 429s must reach ntfy_send to defer the dispatch instead of raising a RetryError    #
+    NTFY_PUSH_HTTP = make_http_session(ntfy_concurrency, Retry(total=2, connect=2, read=False,
+                            status=0, other=0, allowed_methods=None,
+                            respect_retry_after_header=False))
+
+    # a user's topic almost never changes, skip the API round trip per message #
+    TOPIC_CACHE = topiccache.TopicCache(
+                            ttl=int(os.environ.get("NTFY_TOPIC_CACHE_TTL") or 3600),
+                            negative_ttl=int(os.environ.get("NTFY_TOPIC_CACHE_NEGATIVE_TTL") or 300),
+                            max_size=int(os.environ.get("NTFY_TOPIC_CACHE_SIZE") or 10000),
+                            path=os.environ.get("NTFY_TOPIC_CACHE_FILE"))
+
+    # same limits as the ntfy server (defaults: burst 60, one request per 5s) #
+    NTFY_RATE_LIMIT = ratelimit.TokenBucket(
+                            rate=1 / float(os.environ.get("NTFY_RATE_LIMIT_REPLENISH_SECONDS") or 5),
+                            burst=int(os.environ.get("NTFY_RATE_LIMIT_BURST") or 60))
+
+    # one authenticated SMTP connection per email worker, kept open between messages #
+    smtp_idle_timeout = int(os.environ.get("SMTP_IDLE_TIMEOUT_SECONDS") or 60)
+    smtp_starttls = (os.environ.get("SMTP_STARTTLS") or "true").lower() not in ("0", "false", "no")
+    smtp_sessions = smtphelper.SMTPSessionPool(email_concurrency, smtp_target, smtp_port,
+                            smtp_user, smtp_pass, timeout=message_timeout,
+                            idle_timeout=smtp_idle_timeout, starttls=smtp_starttls)
+
+    # per channel send latency & failures for prometheus #
+    metrics_port = os.environ.get("METRICS_PORT")
+    if metrics_port:
+        metrics.serve(int(metrics_port))
+
+    # every channel claims & delivers independently, so one can't stall the others #
+    channels = [
+        DeliveryChannel("ntfy", ["ntfy"], deliver_ntfy, ntfy_concurrency, NTFY_RATE_LIMIT),
+        DeliveryChannel("email", ["email"], deliver_email, email_concurrency),
+        DeliveryChannel("debug", ["debug", "debug-fail"], deliver_debug, debug_concurrency),
+    ]
+
+    pollers = []
+    for channel in channels:
+        poller = threading.Thread(target=channel.run,
+                        args=(claim, claim_limit, long_poll, polling_interval, args.loop),
+                        daemon=True)
+        poller.start()
+        pollers.append(poller)
+
+    # acknowledge all channels' deliveries in batches #
+    while any([ p.is_alive() for p in pollers ]):
+        flush_acknowledgements()
+        TOPIC_CACHE.save()
+        smtp_sessions.close_idle()
+        time.sleep(ACK_FLUSH_INTERVAL)
+
+    flush_acknowledgements()
+    TOPIC_CACHE.save()
+    smtp_sessions.close()
@@ -0,0 +1,28 @@
+import threading
+import prometheus_client
+
+SEND_SECONDS = prometheus_client.Histogram("dispatch_client_send_seconds",
+                        "Delivery latency per channel and outcome", ["channel", "outcome"])
+SEND_FAILURES = prometheus_client.Counter("dispatch_client_send_failures_total",
+                        "Deliveries reported as failed or crashed", ["channel"])
+
+# outcome of the delivery running in the current worker thread #
+_delivery = threading.local()
+
+def start_delivery():
+    _delivery.outcome = None
+
+def set_outcome(outcome):
+    _delivery.outcome = outcome
+
+def observe_delivery(channel, seconds, crashed=False):
+
+    outcome = "crashed" if crashed else (getattr(_delivery, "outcome", None) or "unknown")
+    SEND_SECONDS.labels(channel=channel, outcome=outcome).observe(seconds)
+    if outcome in ("failed", "crashed"):
+        SEND_FAILURES.labels(channel=channel).inc()
+
+def serve(port):
+    '''Expose the metrics over HTTP on <port> in a background thread'''
+
+    prometheus_client.start_http_server(port)
@@ -0,0 +1,81 @@
+import threading
+import time
+
+class TokenBucket:
+    '''Token bucket rate limiter that can additionally be paused (e.g. for Retry-After)'''
+
+    def __init__(self, rate, burst):
+
+        self.rate = rate
+        self.burst = burst
+
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._next_deferred_at = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, max_wait=0):
+        '''Returns (granted, wait)
+
+        If granted the caller may send after sleeping <wait> seconds, the token
+        is already taken. Otherwise nothing is taken and <wait> is the time
+        until a token would be available.
+        '''
+
+        with self._lock:
+
+            now = time.monotonic()
+            self._refill(now)
+
+            if self._paused_until > now:
+                return (False, self._paused_until - now)
+
+            wait = max(0, (1 - self._tokens) / self.rate)
+            if wait > max_wait:
+                return (False, wait)
+
+            self._tokens -= 1
+            return (True, wait)
+
+    def peek(self):
+        '''Return (tokens available now, seconds until the next one) without taking any'''
+
+        with self._lock:
+
+            now = time.monotonic()
+            self._refill(now)
+
+            if self._paused_until > now:
+                return (0, self._paused_until - now)
+
+            if self._tokens < 1:
+                return (0, (1 - self._tokens) / self.rate)
+
+            return (int(self._tokens), 0)
+
+    def defer_delay(self):
+        '''Seconds to hand a message back for, successive callers get successive token slots'''
+
+        with self._lock:
+
+            now = time.monotonic()
+            self._refill(now)
+
+            due = now + max(0, (1 - self._tokens) / self.rate, self._paused_until - now)
+            due = max(due, self._next_deferred_at)
+            self._next_deferred_at = due + 1 / self.rate
+
+            return due - now
+
+    def pause(self, seconds):
+        '''Hand out no tokens for <seconds>'''
+
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
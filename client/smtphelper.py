@@ -1,37 +1,146 @@
+import queue
 import smtplib
+import threading
+import time
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
-def smtp_send(server, port, user, password, recipient, subject, body):
-
-    # Email and password for authentication
-    sender_email = user
-    sender_password = password
-    
-    # Recipient email address
-    recipient_email = recipient
-    
-    # SMTP server details
-    smtp_server = server
-    smtp_port = port or 25
-    
+def _build_message(sender_email, recipient_email, subject, body):
+
     # Create a message
     message = MIMEMultipart()
     message['From'] = sender_email
     message['To'] = recipient_email
     message['Subject'] = subject
-    
+
     # Add body to email
-    body = body
     message.attach(MIMEText(body, 'plain'))
-    
-    # Establish a connection to the SMTP server
-    server = smtplib.SMTP(smtp_server, smtp_port)
-    server.starttls()  # Secure the connection
-    server.login(sender_email, sender_password)
-    
-    # Send the email
-    server.sendmail(sender_email, recipient_email, message.as_string())
-    
-    # Close the connection
-    server.quit()
+    return message.as_string()
+
+class SMTPSession:
+    '''One authenticated SMTP connection, reused for many messages'''
+
+    def __init__(self, server, port, user, password, timeout=60, idle_timeout=60, starttls=True):
+
+        self.server = server
+        self.port = port or 25
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.starttls = starttls
+
+        self._smtp = None
+        self._last_used = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+
+        # Establish a connection to the SMTP server
+        smtp = smtplib.SMTP(self.server, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                smtp.starttls()  # Secure the connection
+            smtp.login(self.user, self.password)
+        except Exception:
+            # don't leave the socket open until garbage collection #
+            smtp.close()
+            raise
+
+        return smtp
+
+    def _close(self):
+
+        if not self._smtp:
+            return
+
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+        self._smtp = None
+
+    def close(self):
+
+        with self._lock:
+            self._close()
+
+    def close_if_idle(self):
+        '''Close the connection if unused for idle_timeout, skipped while sending'''
+
+        if not self._lock.acquire(blocking=False):
+            return
+
+        try:
+            if self._smtp and time.time() - self._last_used > self.idle_timeout:
+                self._close()
+        finally:
+            self._lock.release()
+
+    def send(self, recipient, subject, body):
+
+        message = _build_message(self.user, recipient, subject, body)
+
+        with self._lock:
+
+            # server has most likely dropped us already #
+            if self._smtp and time.time() - self._last_used > self.idle_timeout:
+                self._close()
+
+            for attempt in range(2):
+
+                if not self._smtp:
+                    self._smtp = self._connect()
+
+                try:
+                    self._smtp.sendmail(self.user, recipient, message)
+                    break
+                except smtplib.SMTPServerDisconnected:
+                    # reconnect once, then give up #
+                    self._smtp = None
+                    if attempt > 0:
+                        raise
+
+            self._last_used = time.time()
+
+class SMTPSessionPool:
+    '''Fixed number of SMTP sessions for concurrent senders'''
+
+    def __init__(self, size, server, port, user, password, timeout=60, idle_timeout=60,
+                    starttls=True):
+
+        self.sessions = [ SMTPSession(server, port, user, password, timeout, idle_timeout, starttls)
+                            for _ in range(size) ]
+
+        # LIFO so a burst reuses the warm connections first #
+        self._available = queue.LifoQueue()
+        for session in self.sessions:
+            self._available.put(session)
+
+    def send(self, recipient, subject, body):
+
+        session = self._available.get()
+        try:
+            session.send(recipient, subject, body)
+        finally:
+            self._available.put(session)
+
+    def close_idle(self):
+
+        for session in self.sessions:
+            session.close_if_idle()
+
+    def close(self):
+
+        for session in self.sessions:
+            session.close()
+
+def smtp_send(server, port, user, password, recipient, subject, body, timeout=60, starttls=True):
+    '''Send a single message over a new connection'''
+
+    session = SMTPSession(server, port, user, password, timeout=timeout, starttls=starttls)
+    try:
+        session.send(recipient, subject, body)
+    finally:
+        session.close()
@@ -0,0 +1,87 @@
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+class TopicCache:
+    '''TTL cache for username => ntfy topic, optionally persisted to a JSON file
+
+    Users without a topic are cached as None with a shorter TTL. Least
+    recently used entries are evicted beyond max_size. Changes are only
+    written to the file by save().
+    '''
+
+    def __init__(self, ttl=3600, negative_ttl=300, max_size=10000, path=None):
+
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.path = path
+
+        self._entries = collections.OrderedDict() # username -> (topic, stored_at) #
+        self._lock = threading.Lock()
+        self._dirty = False
+
+        if path:
+            self._load()
+
+    def _load(self):
+
+        if not os.path.isfile(self.path):
+            return
+
+        try:
+            with open(self.path) as f:
+                for username, (topic, stored_at) in json.load(f).items():
+                    self._entries[username] = (topic, stored_at)
+        except (OSError, ValueError) as e:
+            print("Ignoring unreadable topic cache {} ({})".format(self.path, e), file=sys.stderr)
+
+    def save(self):
+        '''Write the cache file if anything changed since the last save'''
+
+        # copy under the lock, write without holding it #
+        with self._lock:
+            if not self.path or not self._dirty:
+                return
+            entries = dict(self._entries)
+            self._dirty = False
+
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print("Failed to persist topic cache {} ({})".format(self.path, e), file=sys.stderr)
+
+    def get(self, username):
+        '''Return (found, topic), topic may be None for a cached "no topic"'''
+
+        with self._lock:
+
+            entry = self._entries.get(username)
+            if not entry:
+                return (False, None)
+
+            topic, stored_at = entry
+            ttl = self.ttl if topic else self.negative_ttl
+            if time.time() - stored_at > ttl:
+                del self._entries[username]
+                return (False, None)
+
+            self._entries.move_to_end(username)
+            return (True, topic)
+
+    def set(self, username, topic):
+
+        with self._lock:
+
+            self._entries[username] = (topic, time.time())
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+            self._dirty = True
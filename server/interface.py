@@ -1,18 +1,26 @@
 #!/usr/bin/python3
 
 import argparse
+import contextlib
 import flask
 import sys
 import subprocess
 import os
+import re
+import json
 import datetime
 import secrets
+import socket
+import threading
+import time
 import yaml
 
 import ldaptools
 import messagetools
+import metrics
+import notifier
 
-from sqlalchemy import Column, Integer, String, Boolean, or_, and_, text
+from sqlalchemy import Column, Integer, Float, String, Boolean, Index, or_, and_, case, text
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.sql import func
@@ -28,16 +36,52 @@ app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DB_URL") or "sqlite:///s
 db = SQLAlchemy(app)
 
 BAD_DISPATCH_ACCESS_TOKEN = "Invalid or missing dispatch-access-token parameter in URL"
+MAX_LONG_POLL_SECONDS = 60
+DEFAULT_MAX_LONG_POLLS = 8
+DEFAULT_CLAIM_LIMIT = 100
+MAX_PAGE_SIZE = 1000
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 10
+DEFAULT_RETRY_BACKOFF_BASE = 30
+DEFAULT_RETRY_BACKOFF_MAX = 3600
+DEFAULT_DIGEST_MAX_LINES = 10
+DEFAULT_SHARED_STATE_REFRESH_SECONDS = 1
+DEFAULT_INTAKE_WORKERS = 4
+DEFAULT_INTAKE_LEASE_SECONDS = 60
+DEFAULT_INTAKE_RETENTION_SECONDS = 86400
+SCHEMA_LOCK_ID = 0x6469737061746368 # pg advisory lock key, "dispatch" #
+
+queue_notifier = notifier.QueueNotifier()
+
+# waiting long-polls may only take part of the server threads, the rest stay free for ingest #
+long_poll_slots = threading.BoundedSemaphore(DEFAULT_MAX_LONG_POLLS)
+intake_notifier = notifier.QueueNotifier()
+
+# identifies this process when holding shared leases #
+PROCESS_ID = "{}-{}".format(socket.gethostname(), os.getpid())
+
+def _compile_substitutions(substitutions):
+    '''Build a single regex matching all substitution keys, longest first'''
+
+    # substitutions.yaml maps replacement => match #
+    replacements = { str(match) : str(replace) for replace, match in substitutions.items()
+                        if match is not None and str(match) }
+    if not replacements:
+        return (None, {})
+
+    matches = sorted(replacements, key=len, reverse=True)
+    return (re.compile("|".join(map(re.escape, matches))), replacements)
 
 def _apply_substitution(string):
 
     if not string:
         return string
 
-    for replace, match in app.config["SUBSTITUTIONS"].items():
-        string = string.replace(match, replace)
+    pattern, replacements = app.config["SUBSTITUTION_PATTERN"]
+    if not pattern:
+        return string
 
-    return string
+    return pattern.sub(lambda m: replacements[m.group(0)], string)
 
 class WebHookPaths(db.Model):
 
@@ -73,21 +117,38 @@ class UserSettings(db.Model):
 class DispatchObject(db.Model):
 
     __tablename__ = "dispatch_queue"
+    __table_args__ = (
+        Index("ix_dispatch_queue_method_timestamp", "method", "timestamp"),
+    )
 
-    username = Column(String, primary_key=True)
-    timestamp = Column(Integer, primary_key=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+
+    username = Column(String)
+    timestamp = Column(Integer)
     phone = Column(String)
     email = Column(String)
 
     title = Column(String)
-    message = Column(String, primary_key=True)
+    message = Column(String)
     method = Column(String)
     link = Column(String)
 
-    dispatch_secret = Column(String)
+    dispatch_secret = Column(String, unique=True, index=True)
     dispatch_error = Column(String)
 
-    def serialize(self):
+    # set while a worker has claimed the dispatch #
+    lease_owner = Column(String)
+    lease_expires_at = Column(Float)
+
+    # failed deliveries are retried with exponential backoff #
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(Float)
+
+    # number of messages merged into this dispatch as a digest #
+    coalesced = Column(Integer, default=1)
+
+    def serialize(self, method=None):
+        '''Serialize, method is the resolved concrete method for "any" dispatches'''
 
         ret = {
             "person" : self.username, # legacy field TODO remove at some point
@@ -95,12 +156,13 @@ class DispatchObject(db.Model):
             "timestamp" : self.timestamp,
             "phone" : self.phone,
             "email" : self.email,
-            "title" : _apply_substitution(self.title),
-            "message" : _apply_substitution(self.message),
+            "title" : self.title,
+            "message" : self.message,
             "link" : self.link,
             "uuid" : self.dispatch_secret,
-            "method" : self.method,
+            "method" : method or self.method,
             "error" : self.dispatch_error,
+            "attempts" : self.attempts or 0,
         }
 
         # fix bytes => string from LDAP #
@@ -108,18 +170,404 @@ class DispatchObject(db.Model):
             if type(value) == bytes:
                 ret[key] = value.decode("utf-8")
 
-        if ret["method"] == "any":
-            user_settings = db.session.query(UserSettings).filter(
-                                UserSettings.username == ret["username"]).first()
+        return ret
 
-            if not user_settings and self.email:
-                ret["method"] = "email"
-            elif user_settings:
-                ret["method"] = user_settings.get_highest_prio_method()
-            else:
-                ret["method"] = "ntfy"
+def _resolved_method():
+    '''SQL expression resolving "any" to a concrete method, needs an outer join on UserSettings'''
 
-        return ret
+    has_email = and_(DispatchObject.email.isnot(None), DispatchObject.email != "")
+    return case(
+        (DispatchObject.method != "any", DispatchObject.method),
+        (and_(UserSettings.username.is_(None), has_email), "email"),
+        (UserSettings.username.is_(None), "ntfy"),
+        (UserSettings.email_priority >= UserSettings.ntfy_priority, "email"),
+        else_="ntfy")
+
+class DeadLetter(db.Model):
+
+    __tablename__ = "dead_letters"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+
+    username = Column(String)
+    timestamp = Column(Integer)
+    phone = Column(String)
+    email = Column(String)
+
+    title = Column(String)
+    message = Column(String)
+    method = Column(String)
+    link = Column(String)
+
+    dispatch_secret = Column(String, unique=True, index=True)
+    dispatch_error = Column(String)
+    attempts = Column(Integer)
+    failed_at = Column(Float)
+
+    def serialize(self):
+        return {
+            "username" : self.username,
+            "timestamp" : self.timestamp,
+            "title" : self.title,
+            "message" : self.message,
+            "method" : self.method,
+            "uuid" : self.dispatch_secret,
+            "error" : self.dispatch_error,
+            "attempts" : self.attempts,
+            "failed_at" : self.failed_at,
+        }
+
+# columns kept when moving rows between dispatch_queue and dead_letters #
+DEAD_LETTER_COLUMNS = ["username", "timestamp", "phone", "email", "title", "message", "method",
+                        "link", "dispatch_secret", "dispatch_error", "attempts"]
+
+class IntakeRequest(db.Model):
+    '''Raw /smart-send request waiting for recipient resolution (async ingest)'''
+
+    __tablename__ = "intake_requests"
+
+    request_id = Column(String, primary_key=True)
+    created_at = Column(Float, index=True)
+
+    # recipients as JSON lists #
+    users = Column(String)
+    groups = Column(String)
+
+    title = Column(String)
+    message = Column(String)
+    method = Column(String)
+    link = Column(String)
+
+    # pending => processing => done|failed, processing rows with an expired lease are reclaimed #
+    status = Column(String, index=True)
+    lease_expires_at = Column(Float)
+    attempts = Column(Integer, default=0)
+    error = Column(String)
+
+    dispatch_secrets = Column(String)
+
+    def serialize(self):
+        return {
+            "request_id" : self.request_id,
+            "status" : self.status,
+            "error" : self.error,
+            "dispatch_secrets" : json.loads(self.dispatch_secrets) if self.dispatch_secrets else [],
+        }
+
+def _lease_available(now):
+    return or_(DispatchObject.lease_expires_at.is_(None), DispatchObject.lease_expires_at < now)
+
+def _dispatchable(now):
+    '''Not leased to a worker and not waiting for a retry'''
+
+    return and_(_lease_available(now), or_(DispatchObject.next_attempt_at.is_(None),
+                                           DispatchObject.next_attempt_at <= now))
+
+def _method_condition(methods):
+    '''Rows for any of <methods>, "any" rows by the method resolved from user settings'''
+
+    return and_(DispatchObject.method.in_(methods + ["any"]), _resolved_method().in_(methods))
+
+def _next_due(methods):
+    '''Earliest future retry/deferral or lease expiry of the matching rows, or None'''
+
+    now = time.time()
+    query = db.session.query(
+                    func.min(case((DispatchObject.next_attempt_at > now, DispatchObject.next_attempt_at))),
+                    func.min(case((DispatchObject.lease_expires_at > now, DispatchObject.lease_expires_at)))
+                ).outerjoin(UserSettings, UserSettings.username == DispatchObject.username)
+
+    if "all" not in methods:
+        query = query.filter(_method_condition(methods))
+
+    due = [ t for t in query.one() if t ]
+    return min(due) if due else None
+
+def _query_dispatch_objects():
+    '''Query (DispatchObject, resolved method) tuples in a single statement'''
+
+    return db.session.query(DispatchObject, _resolved_method()).outerjoin(
+                UserSettings, UserSettings.username == DispatchObject.username)
+
+class DirectoryPerson(db.Model):
+
+    __tablename__ = "directory_persons"
+
+    cn = Column(String, primary_key=True)
+    username = Column(String, index=True)
+    name = Column(String)
+    email = Column(String)
+    phone = Column(String)
+
+    def to_person(self):
+        return ldaptools.Person(cn=self.cn, username=self.username, name=self.name,
+                    email=self.email, phone=self.phone)
+
+class DirectoryGroupMember(db.Model):
+
+    __tablename__ = "directory_group_members"
+
+    group = Column(String, primary_key=True)
+    username = Column(String, primary_key=True, index=True)
+
+class SharedState(db.Model):
+    '''Small values shared between all worker processes, version is bumped on every change'''
+
+    __tablename__ = "shared_state"
+
+    name = Column(String, primary_key=True)
+    value = Column(String)
+    version = Column(Integer, default=0)
+
+# per process cache of the shared state: name => (value, version, checked_at) #
+_shared_state_cache = {}
+_shared_state_lock = threading.Lock()
+
+def _refresh_shared_state(name):
+
+    with _shared_state_lock:
+        cached = _shared_state_cache.get(name)
+
+    interval = app.config.get("SHARED_STATE_REFRESH_SECONDS", DEFAULT_SHARED_STATE_REFRESH_SECONDS)
+    if cached and time.monotonic() - cached[2] < interval:
+        return cached
+
+    row = db.session.get(SharedState, name)
+    value, version = (row.value, row.version) if row else (None, 0)
+
+    # another worker may have written meanwhile, never go back to an older version #
+    with _shared_state_lock:
+        cached = _shared_state_cache.get(name)
+        if not cached or cached[1] <= version:
+            cached = (value, version, time.monotonic())
+            _shared_state_cache[name] = cached
+
+    return cached
+
+def get_shared_state(name):
+    '''Read a shared value, at most one database hit per refresh interval'''
+
+    return _refresh_shared_state(name)[0]
+
+def get_shared_state_version(name):
+
+    return _refresh_shared_state(name)[1]
+
+def set_shared_state(name, value):
+    '''Write a shared value and bump its version, returns the new version'''
+
+    updated = db.session.query(SharedState).filter(SharedState.name == name).update({
+                    "value" : value,
+                    "version" : SharedState.version + 1 }, synchronize_session=False)
+
+    if not updated:
+        try:
+            with db.session.begin_nested():
+                db.session.add(SharedState(name=name, value=value, version=1))
+        except IntegrityError:
+            # created concurrently by another worker #
+            db.session.query(SharedState).filter(SharedState.name == name).update({
+                    "value" : value,
+                    "version" : SharedState.version + 1 }, synchronize_session=False)
+
+    version = db.session.query(SharedState.version).filter(SharedState.name == name).scalar()
+    db.session.commit()
+
+    with _shared_state_lock:
+        _shared_state_cache[name] = (value, version, time.monotonic())
+
+    return version
+
+# webhook path => username, reloaded when the "webhooks" shared state version changes #
+_webhook_index = { "version" : None, "paths" : {} }
+_webhook_index_lock = threading.Lock()
+
+def _load_webhook_index():
+
+    version = get_shared_state_version("webhooks")
+    paths = { wh.path : wh.username for wh in db.session.query(WebHookPaths).all() }
+
+    with _webhook_index_lock:
+        _webhook_index["version"] = version
+        _webhook_index["paths"] = paths
+
+def _webhook_index_changed(path, username):
+    '''Apply a local webhook change to the index and tell other workers, username None deletes'''
+
+    version = set_shared_state("webhooks", str(time.time()))
+
+    with _webhook_index_lock:
+
+        # somebody else changed something too, reload on next lookup #
+        if _webhook_index["version"] != version - 1:
+            _webhook_index["version"] = None
+            return
+
+        if username:
+            _webhook_index["paths"][path] = username
+        else:
+            _webhook_index["paths"].pop(path, None)
+        _webhook_index["version"] = version
+
+def get_webhook_user(path):
+    '''Username owning a webhook path or None'''
+
+    if get_shared_state_version("webhooks") != _webhook_index["version"]:
+        _load_webhook_index()
+
+    # no database fallback on a miss, unknown paths are attacker controlled, a path #
+    # created by another worker is picked up with the next shared state refresh    #
+    return _webhook_index["paths"].get(path)
+
+def claim_shared_lease(name, seconds, owner=PROCESS_ID):
+    '''Take or renew a lease stored in shared_state, True if <owner> holds it afterwards'''
+
+    now = time.time()
+    lease = json.dumps({ "owner" : owner, "expires_at" : now + seconds })
+
+    row = db.session.get(SharedState, name)
+    if not row:
+        try:
+            with db.session.begin_nested():
+                db.session.add(SharedState(name=name, value=lease, version=1))
+            db.session.commit()
+            return True
+        except IntegrityError:
+            db.session.rollback()
+            return False
+
+    current = json.loads(row.value) if row.value else {}
+    if current.get("owner") != owner and (current.get("expires_at") or 0) > now:
+        db.session.rollback()
+        return False
+
+    # compare and set on the version, so only one of several claimers wins #
+    claimed = db.session.query(SharedState).filter(SharedState.name == name,
+                    SharedState.version == row.version).update({
+                        "value" : lease,
+                        "version" : SharedState.version + 1 }, synchronize_session=False)
+    db.session.commit()
+
+    return bool(claimed)
+
+def get_downtime():
+
+    value = get_shared_state("downtime")
+    if not value:
+        return datetime.datetime.fromtimestamp(0)
+
+    return datetime.datetime.fromtimestamp(float(value))
+
+def set_downtime(until):
+
+    set_shared_state("downtime", str(until.timestamp()))
+
+def sync_directory_snapshot(full=False):
+    '''Sync persons and group memberships from LDAP into the local directory tables'''
+
+    ldap_args = app.config["LDAP_ARGS"]
+    state = get_directory_snapshot_state()
+
+    persons_since = None if full else state.get("persons_watermark")
+    groups_since = None if full else state.get("groups_watermark")
+
+    persons, persons_watermark = ldaptools.search_persons(ldap_args, modified_since=persons_since)
+    groups, groups_watermark = ldaptools.search_groups(ldap_args, modified_since=groups_since)
+
+    # fetch full name lists to detect deletions #
+    person_dns = ldaptools.search_person_dns(ldap_args)
+    group_names = ldaptools.search_group_names(ldap_args)
+
+    def normalize(v):
+        return v.decode("utf-8") if isinstance(v, bytes) else v
+
+    for p in persons:
+        db.session.merge(DirectoryPerson(cn=p.cn, username=normalize(p.username),
+                            name=normalize(p.name), email=normalize(p.email),
+                            phone=normalize(p.phone)))
+
+    for group, usernames in groups.items():
+        db.session.query(DirectoryGroupMember).filter(DirectoryGroupMember.group==group).delete()
+        for username in set(usernames):
+            db.session.add(DirectoryGroupMember(group=group, username=username))
+
+    local_dns = set([ cn for (cn,) in db.session.query(DirectoryPerson.cn) ])
+    deleted_dns = list(local_dns - person_dns)
+    if deleted_dns:
+        db.session.query(DirectoryPerson).filter(DirectoryPerson.cn.in_(deleted_dns)).delete()
+
+    local_groups = set([ g for (g,) in db.session.query(DirectoryGroupMember.group).distinct() ])
+    deleted_groups = list(local_groups - group_names)
+    if deleted_groups:
+        db.session.query(DirectoryGroupMember).filter(
+                        DirectoryGroupMember.group.in_(deleted_groups)).delete()
+
+    db.session.commit()
+
+    _update_directory_snapshot_state(persons_watermark=persons_watermark,
+                    groups_watermark=groups_watermark, last_sync=time.time(), last_error=None)
+
+    print("Directory snapshot synced: {} persons, {} groups updated".format(
+                len(persons), len(groups)), file=sys.stderr)
+
+def get_directory_snapshot_state():
+    '''Watermarks, last sync and last error of the directory snapshot, shared by all workers'''
+
+    value = get_shared_state("directory_snapshot")
+    return json.loads(value) if value else {}
+
+def _update_directory_snapshot_state(**changes):
+
+    state = get_directory_snapshot_state()
+    state.update(changes)
+    set_shared_state("directory_snapshot", json.dumps(state))
+
+def _directory_sync_loop(interval):
+
+    # only one process syncs, the lease outlives a sync and is renewed every interval #
+    lease_seconds = interval * 2 + 60
+
+    while True:
+        with app.app_context():
+            try:
+                if claim_shared_lease("directory_snapshot_owner", lease_seconds):
+                    sync_directory_snapshot()
+            except Exception as e:
+                db.session.rollback()
+                print("Directory snapshot sync failed: {}".format(e), file=sys.stderr)
+                try:
+                    _update_directory_snapshot_state(last_error=str(e))
+                except Exception:
+                    db.session.rollback()
+            finally:
+                db.session.remove()
+
+        time.sleep(interval)
+
+def select_targets_from_snapshot(users, groups, admin_group="pki"):
+    '''Same as ldaptools.select_targets but only using the local directory tables'''
+
+    query = db.session.query(DirectoryPerson)
+
+    if users and not any([ not s for s in users]):
+        rows = query.filter(DirectoryPerson.username.in_(users)).all()
+    else:
+        if not (groups and not any([ not s for s in groups ])):
+            groups = [admin_group]
+
+        rows = query.join(DirectoryGroupMember,
+                    DirectoryGroupMember.username == DirectoryPerson.username).filter(
+                    DirectoryGroupMember.group.in_(groups)).all()
+
+    return set([ r.to_person() for r in rows ])
+
+def _select_targets(users, groups):
+
+    # resolve from the local snapshot once it has been synced at least once #
+    if app.config.get("LDAP_SNAPSHOT_INTERVAL") and get_directory_snapshot_state().get("last_sync"):
+        return select_targets_from_snapshot(users, groups)
+    else:
+        return ldaptools.select_targets(users, groups, app.config["LDAP_ARGS"])
 
 @app.route('/get-dispatch-status')
 def get_dispatch_status():
@@ -149,6 +597,7 @@ def webhooks():
         posted = WebHookPaths(username=user, path=secrets.token_urlsafe(20))
         db.session.merge(posted)
         db.session.commit()
+        _webhook_index_changed(posted.path, user)
         return flask.jsonify({ "webhook-identity": posted.path})
     elif flask.request.method == "GET":
         webhooks = db.session.query(WebHookPaths).filter(WebHookPaths.username==user).all()
@@ -165,6 +614,7 @@ def webhooks():
         else:
             db.session.delete(webhook_to_be_deleted)
             db.session.commit()
+            _webhook_index_changed(path, None)
             return ("", 204)
 
 @app.route('/downtime', methods=["GET", "DELETE","POST"])
@@ -176,14 +626,15 @@ def downtime():
         return ("SETTINGS_ACCESS_TOKEN incorrect. Refusing to access downtime settings", 401)
 
     if flask.request.method == "DELETE":
-        app.config["DOWNTIME"] = datetime.datetime.now()
+        set_downtime(datetime.datetime.now())
         return ('Downtime successfully disabled', 200)
     elif flask.request.method == "POST":
         minutes = int(flask.request.args.get("minutes") or 5)
-        app.config["DOWNTIME"] = datetime.datetime.now() + datetime.timedelta(minutes=minutes)
-        return ('Downtime set to {}'.format(app.config["DOWNTIME"].isoformat(), 204))
+        dt = datetime.datetime.now() + datetime.timedelta(minutes=minutes)
+        set_downtime(dt)
+        return ('Downtime set to {}'.format(dt.isoformat(), 204))
     elif flask.request.method == "GET":
-        dt = app.config["DOWNTIME"]
+        dt = get_downtime()
         if dt < datetime.datetime.now():
             return flask.jsonify({"title" : "No Downtime set at the moment", "message" : ""})
         else:
@@ -191,6 +642,20 @@ def downtime():
             return flask.jsonify({"title" : "Downtime set for {}m until {}".format(delta, dt.isoformat()),
                      "message" : ""})
 
+@app.route('/ldap-cache', methods=["GET", "DELETE"])
+def ldap_cache():
+
+    # check static access token #
+    token = flask.request.args.get("token")
+    if token != app.config["SETTINGS_ACCESS_TOKEN"]:
+        return ("SETTINGS_ACCESS_TOKEN incorrect. Refusing to access ldap cache", 401)
+
+    if flask.request.method == "DELETE":
+        ldaptools.cache.clear()
+        return ('', 204)
+    elif flask.request.method == "GET":
+        return flask.jsonify(ldaptools.cache.stats())
+
 
 @app.route('/settings', methods=["GET", "POST"])
 def settings():
@@ -230,6 +695,19 @@ def get_dispatch():
     method = flask.request.args.get("method")
     timeout = flask.request.args.get("timeout") or 5 # timeout in seconds
     timeout = int(timeout)
+    wait = min(int(flask.request.args.get("wait") or 0), MAX_LONG_POLL_SECONDS)
+    limit = min(int(flask.request.args.get("limit") or MAX_PAGE_SIZE), MAX_PAGE_SIZE)
+    if limit < 1:
+        return ("limit must be at least 1", 400)
+
+    # keyset cursor "<timestamp>:<id>" of the last row of the previous page #
+    cursor = flask.request.args.get("cursor")
+    if cursor:
+        try:
+            cursor_timestamp, cursor_id = cursor.split(":")
+            cursor_timestamp, cursor_id = float(cursor_timestamp), int(cursor_id)
+        except ValueError:
+            return ("Invalid cursor", 400)
 
     dispatch_acces_token = flask.request.args.get("dispatch-access-token") or ""
     if dispatch_acces_token != app.config["DISPATCH_ACCESS_TOKEN"]:
@@ -238,69 +716,297 @@ def get_dispatch():
     if not method:
         return (500, "Missing Dispatch Target (email|phone|ntfy|all|any)")
 
-    # prevent message floods #
-    timeout_cutoff = datetime.datetime.now() - datetime.timedelta(seconds=timeout)
-    timeout_cutoff_timestamp = timeout_cutoff.timestamp()
+    def fetch():
 
-    lines_unfiltered = db.session.query(DispatchObject)
-    lines_timeout = lines_unfiltered.filter(DispatchObject.timestamp < timeout_cutoff_timestamp)
+        # prevent message floods #
+        timeout_cutoff = datetime.datetime.now() - datetime.timedelta(seconds=timeout)
+        timeout_cutoff_timestamp = timeout_cutoff.timestamp()
 
-    if method != "all":
+        lines_unfiltered = _query_dispatch_objects()
+        lines_timeout = lines_unfiltered.filter(DispatchObject.timestamp < timeout_cutoff_timestamp,
+                                    _dispatchable(time.time()))
 
-        dispatch_objects = lines_timeout.filter(DispatchObject.method==method).all()
+        # "any" is resolved in the same query via the joined user settings #
+        if method != "all":
+            lines_timeout = lines_timeout.filter(_method_condition([method]))
 
-        dispatch_objects_any = lines_timeout.filter(DispatchObject.method=="any").all()
-        for d in dispatch_objects_any:
-            user_str = str(d.username, "utf-8")
-            user_settings = db.session.query(UserSettings).filter(UserSettings.username==user_str).first()
-            if user_settings and user_settings.get_highest_prio_method() == method:
-                dispatch_objects += [d]
-    else:
-        dispatch_objects = lines_timeout.all()
+        if cursor:
+            lines_timeout = lines_timeout.filter(or_(
+                                    DispatchObject.timestamp > cursor_timestamp,
+                                    and_(DispatchObject.timestamp == cursor_timestamp,
+                                         DispatchObject.id > cursor_id)))
+
+        return lines_timeout.order_by(DispatchObject.timestamp, DispatchObject.id).limit(limit).all()
+
+    dispatch_objects = _long_poll(fetch, wait, timeout, lambda: _next_due([method]))
+    response = flask.jsonify([ d.serialize(resolved) for d, resolved in dispatch_objects])
+
+    # a full page means there may be more #
+    if dispatch_objects and len(dispatch_objects) == limit:
+        last, _ = dispatch_objects[-1]
+        response.headers["X-Next-Cursor"] = "{}:{}".format(last.timestamp, last.id)
+
+    return response
+
+def _long_poll(fetch, wait, timeout=0, next_due=None):
+    '''Run fetch until it returns something or <wait> seconds passed, sleeping until enqueues
+
+    next_due returns when the next retried, deferred or leased row becomes claimable
+    again, nothing notifies about those.
+    '''
+
+    deadline = time.time() + wait
+    waiting = False
+    try:
+        while True:
+
+            # read version before fetching so no enqueue in between is missed #
+            version = queue_notifier.version
+            results = fetch()
+
+            remaining = deadline - time.time()
+            if results or remaining <= 0:
+                return results
+
+            # all long-poll slots taken, answer right away instead of tying up a thread #
+            if not waiting:
+                waiting = long_poll_slots.acquire(blocking=False)
+                if not waiting:
+                    return results
+
+            if next_due:
+                due = next_due()
+                if due:
+                    remaining = min(remaining, max(due - time.time(), 0.05))
+
+            # don't hold a connection/transaction while waiting #
+            db.session.rollback()
+
+            # rows only become visible after <timeout> seconds or the coalescing window, #
+            # so recheck at least that often                                             #
+            recheck = max(timeout, app.config.get("COALESCE_WINDOW_SECONDS") or 0)
+            if recheck:
+                remaining = min(remaining, max(recheck, 1))
+
+            queue_notifier.wait(version, remaining)
+    finally:
+        if waiting:
+            long_poll_slots.release()
+
+@app.route('/claim-dispatch', methods=["POST"])
+def claim_dispatch():
+    '''Lease up to <limit> dispatches to a worker, so parallel workers never send the same one'''
+
+    method = flask.request.args.get("method")
+    worker = flask.request.args.get("worker")
+    timeout = int(flask.request.args.get("timeout") or 0)
+    wait = min(int(flask.request.args.get("wait") or 0), MAX_LONG_POLL_SECONDS)
+    limit = min(int(flask.request.args.get("limit") or DEFAULT_CLAIM_LIMIT), MAX_PAGE_SIZE)
+    lease = int(flask.request.args.get("lease") or DEFAULT_LEASE_SECONDS)
+    if limit < 1:
+        return ("limit must be at least 1", 400)
+
+    dispatch_acces_token = flask.request.args.get("dispatch-access-token") or ""
+    if dispatch_acces_token != app.config["DISPATCH_ACCESS_TOKEN"]:
+        return (BAD_DISPATCH_ACCESS_TOKEN, 401)
+
+    if not method:
+        return ("Missing Dispatch Target (email|phone|ntfy|all|any)", 400)
+    if not worker:
+        return ("Missing worker parameter in URL", 400)
+
+    # comma separated list of methods, e.g. "debug,debug-fail" #
+    methods = method.split(",")
+
+    def fetch():
+
+        now = time.time()
+        lease_expires_at = now + lease
+        timeout_cutoff_timestamp = now - timeout
+
+        # oldest claimable rows, expired leases are claimable again #
+        candidates = sqlalchemy.select(DispatchObject.id).outerjoin(
+                        UserSettings, UserSettings.username == DispatchObject.username).where(
+                        DispatchObject.timestamp < timeout_cutoff_timestamp,
+                        _dispatchable(now))
+
+        if "all" not in methods:
+            candidates = candidates.where(_method_condition(methods))
+
+        candidates = candidates.order_by(DispatchObject.timestamp, DispatchObject.id).limit(limit)
+
+        # postgres: skip rows other workers are claiming right now #
+        # sqlite: the single UPDATE below is atomic on its own     #
+        candidates = candidates.with_for_update(skip_locked=True, of=DispatchObject)
+
+        # RETURNING the claimed ids, channels of one client share the worker name #
+        # and may claim within the same clock tick                                #
+        claim = sqlalchemy.update(DispatchObject).where(
+                        DispatchObject.id.in_(candidates), _dispatchable(now)).values(
+                        lease_owner=worker, lease_expires_at=lease_expires_at).returning(
+                        DispatchObject.id).execution_options(synchronize_session=False)
+
+        claimed_ids = db.session.execute(claim).scalars().all()
+        if not claimed_ids:
+            db.session.rollback()
+            return []
+
+        db.session.commit()
+
+        return _query_dispatch_objects().filter(DispatchObject.id.in_(claimed_ids)).order_by(
+                        DispatchObject.timestamp, DispatchObject.id).all()
+
+    dispatch_objects = _long_poll(fetch, wait, timeout, lambda: _next_due(methods))
+    return flask.jsonify([ d.serialize(resolved) for d, resolved in dispatch_objects])
+
+def _existing_dispatch_secrets(uuids):
+    return set([ s for (s,) in db.session.query(DispatchObject.dispatch_secret).filter(
+                                    DispatchObject.dispatch_secret.in_(uuids)) ])
+
+def _retry_delay(attempts):
+    '''Exponential backoff in seconds after <attempts> failed attempts'''
 
-    return flask.jsonify([ d.serialize() for d in dispatch_objects])
+    base = app.config.get("RETRY_BACKOFF_BASE") or DEFAULT_RETRY_BACKOFF_BASE
+    maximum = app.config.get("RETRY_BACKOFF_MAX") or DEFAULT_RETRY_BACKOFF_MAX
+    return min(base * 2 ** (attempts - 1), maximum)
 
 @app.route('/report-dispatch-failed', methods=["POST"])
 def reject_dispatch():
-    '''Inform the server that a dispatch has failed'''
+    '''Inform the server that dispatches have failed, returns a status per uuid'''
 
     rejects = flask.request.json
+    errors = { r["uuid"] : r["error"] for r in rejects }
+
+    rows = db.session.query(DispatchObject.dispatch_secret, DispatchObject.attempts).filter(
+                        DispatchObject.dispatch_secret.in_(list(errors.keys()))).all()
+
+    now = time.time()
+    max_attempts = app.config.get("MAX_DISPATCH_ATTEMPTS") or DEFAULT_MAX_ATTEMPTS
+
+    results = { uuid : "not-found" for uuid in errors }
+    retries = []
+    dead = []
+    for uuid, attempts in rows:
+        attempts = (attempts or 0) + 1
+        if attempts >= max_attempts:
+            dead.append(uuid)
+            results[uuid] = "dead-letter"
+        else:
+            results[uuid] = "retry"
+        retries.append({ "b_uuid" : uuid, "b_error" : errors[uuid], "b_attempts" : attempts,
+                         "b_next_attempt_at" : now + _retry_delay(attempts) })
+
+    # one executemany UPDATE, release the lease and schedule the retry #
+    if retries:
+        table = DispatchObject.__table__
+        stmt = sqlalchemy.update(table).where(
+                        table.c.dispatch_secret == sqlalchemy.bindparam("b_uuid")).values(
+                        dispatch_error=sqlalchemy.bindparam("b_error"),
+                        attempts=sqlalchemy.bindparam("b_attempts"),
+                        next_attempt_at=sqlalchemy.bindparam("b_next_attempt_at"),
+                        lease_owner=None, lease_expires_at=None)
+        db.session.execute(stmt, retries)
+
+    # move rows past the attempt limit to the dead letter table #
+    if dead:
+        columns = [ DispatchObject.__table__.c[name] for name in DEAD_LETTER_COLUMNS ]
+        select = sqlalchemy.select(*columns, sqlalchemy.literal(now)).where(
+                        DispatchObject.dispatch_secret.in_(dead))
+        db.session.execute(sqlalchemy.insert(DeadLetter).from_select(
+                        DEAD_LETTER_COLUMNS + ["failed_at"], select))
+        db.session.query(DispatchObject).filter(DispatchObject.dispatch_secret.in_(dead)).delete(
+                        synchronize_session=False)
+
+    db.session.commit()
+
+    return flask.jsonify(results)
+
+@app.route('/dead-letters', methods=["GET"])
+def dead_letters():
+    '''List dispatches that exceeded the maximum number of attempts'''
 
-    for r in rejects:
+    # check static access token #
+    token = flask.request.args.get("token")
+    if token != app.config["SETTINGS_ACCESS_TOKEN"]:
+        return ("SETTINGS_ACCESS_TOKEN incorrect. Refusing to access dead letters", 401)
 
-        uuid = r["uuid"]
-        error = r["error"]
-        dpo = db.session.query(DispatchObject).filter(
-                        DispatchObject.dispatch_secret == uuid).first()
+    limit = min(int(flask.request.args.get("limit") or MAX_PAGE_SIZE), MAX_PAGE_SIZE)
+    rows = db.session.query(DeadLetter).order_by(DeadLetter.failed_at.desc()).limit(limit).all()
+    return flask.jsonify([ r.serialize() for r in rows ])
 
-        if not dpo:
-            return ("No pending dispatch for this UID/Secret", 404)
+@app.route('/dead-letters/requeue', methods=["POST"])
+def requeue_dead_letters():
+    '''Move dead letters back into the dispatch queue with a fresh attempt count'''
 
-        dpo.dispatch_error = error
-        db.session.merge(dpo)
-        db.session.commit()
-
-    return ("", 204)
+    # check static access token #
+    token = flask.request.args.get("token")
+    if token != app.config["SETTINGS_ACCESS_TOKEN"]:
+        return ("SETTINGS_ACCESS_TOKEN incorrect. Refusing to access dead letters", 401)
+
+    uuids = [ r["uuid"] for r in flask.request.json ]
+    found = set([ s for (s,) in db.session.query(DeadLetter.dispatch_secret).filter(
+                                    DeadLetter.dispatch_secret.in_(uuids)) ])
+
+    if found:
+        # fresh attempt count and no error, otherwise the row still looks failed #
+        names = [ name for name in DEAD_LETTER_COLUMNS if name not in ("attempts", "dispatch_error") ]
+        columns = [ DeadLetter.__table__.c[name] for name in names ]
+        select = sqlalchemy.select(*columns, sqlalchemy.literal(0), sqlalchemy.null()).where(
+                        DeadLetter.dispatch_secret.in_(found))
+        db.session.execute(sqlalchemy.insert(DispatchObject).from_select(
+                        names + ["attempts", "dispatch_error"], select))
+        db.session.query(DeadLetter).filter(DeadLetter.dispatch_secret.in_(found)).delete(
+                        synchronize_session=False)
+
+    db.session.commit()
+    queue_notifier.notify()
+
+    return flask.jsonify({ uuid : "requeued" if uuid in found else "not-found" for uuid in uuids })
+
+@app.route('/defer-dispatch', methods=["POST"])
+def defer_dispatch():
+    '''Put claimed dispatches back without an error, claimable again after <seconds>'''
+
+    deferrals = flask.request.json
+    not_before = { d["uuid"] : time.time() + float(d["seconds"]) for d in deferrals }
+    found = _existing_dispatch_secrets(list(not_before.keys()))
+
+    # release the lease, but don't count it as an attempt #
+    if found:
+        table = DispatchObject.__table__
+        stmt = sqlalchemy.update(table).where(
+                        table.c.dispatch_secret == sqlalchemy.bindparam("b_uuid")).values(
+                        next_attempt_at=sqlalchemy.bindparam("b_not_before"),
+                        lease_owner=None, lease_expires_at=None)
+        db.session.execute(stmt, [ { "b_uuid" : uuid, "b_not_before" : not_before[uuid] }
+                                        for uuid in found ])
+
+    db.session.commit()
+
+    return flask.jsonify({ uuid : "deferred" if uuid in found else "not-found" for uuid in not_before })
 
 @app.route('/confirm-dispatch', methods=["POST"])
 def confirm_dispatch():
-    '''Confirm that a message has been dispatched by replying with its dispatch secret/uid'''
+    '''Confirm that messages have been dispatched by replying with their dispatch secrets/uids'''
 
     confirms = flask.request.json
+    uuids = [ c["uuid"] for c in confirms ]
+    enqueued = dict(db.session.query(DispatchObject.dispatch_secret, DispatchObject.timestamp).filter(
+                                    DispatchObject.dispatch_secret.in_(uuids)).all())
+    found = set(enqueued)
 
-    for c in confirms:
+    # one DELETE ... WHERE dispatch_secret IN (...) in one transaction #
+    if found:
+        db.session.query(DispatchObject).filter(DispatchObject.dispatch_secret.in_(found)).delete(
+                        synchronize_session=False)
 
-        uuid = c["uuid"]
-        dpo = db.session.query(DispatchObject).filter(
-                        DispatchObject.dispatch_secret == uuid).first()
+    db.session.commit()
 
-        if not dpo:
-            return ("No pending dispatch for this UID/Secret", 404)
+    now = time.time()
+    for timestamp in enqueued.values():
+        metrics.ENQUEUE_TO_CONFIRM_SECONDS.observe(max(0, now - timestamp))
 
-        db.session.delete(dpo)
-        db.session.commit()
-
-    return ("", 204)
+    return flask.jsonify({ uuid : "confirmed" if uuid in found else "not-found" for uuid in uuids })
 
 
 @app.route('/smart-send/<path:path>', methods=["POST"])
@@ -332,6 +1038,7 @@ def smart_send_to_clients(path=None):
         message = flask.request.get_data(as_text=True)
         title = "Opensearch Alert"
         method = None
+        link = None
 
     else:
 
@@ -343,9 +1050,10 @@ def smart_send_to_clients(path=None):
         method = instructions.get("method")
         link = instructions.get("link")
 
-    if app.config["DOWNTIME"] > datetime.datetime.now():
+    downtime_until = get_downtime()
+    if downtime_until > datetime.datetime.now():
         print("Ignoring because of Downtime:", title, message, users, file=sys.stderr)
-        print("Downtime until", app.config["DOWNTIME"].isoformat(), file=sys.stderr)
+        print("Downtime until", downtime_until.isoformat(), file=sys.stderr)
         return ("Ignored because of Downtime", 200)
 
     # authenticated by access token or webhook path #
@@ -354,9 +1062,9 @@ def smart_send_to_clients(path=None):
         dispatch_acces_token = flask.request.headers.get("Dispatcher-Token") or ""
 
     if path:
-        webhook_path = db.session.query(WebHookPaths).filter(WebHookPaths.path==path).first()
-        if webhook_path:
-            users = webhook_path.username
+        webhook_user = get_webhook_user(path)
+        if webhook_user:
+            users = webhook_user
             groups = None
         else:
             return ("Invalid Webhook path", 401)
@@ -375,54 +1083,295 @@ def smart_send_to_clients(path=None):
             print(str(e), file=sys.stderr)
             return (e.response(), 408)
 
+    # resolve recipients in the background and answer right away #
+    if app.config.get("ASYNC_INGEST"):
+        request_id = secrets.token_urlsafe(16)
+        db.session.add(IntakeRequest(request_id=request_id, created_at=time.time(),
+                            users=json.dumps(users), groups=json.dumps(groups),
+                            title=title, message=message, method=method, link=link,
+                            status="pending"))
+        db.session.commit()
+        intake_notifier.notify()
+        return (flask.jsonify({ "request_id" : request_id }), 202)
+
+    dispatch_secrets = _resolve_and_enqueue(users, groups, title, message, method, link)
+    return flask.jsonify(dispatch_secrets)
+
+@app.route('/smart-send-status/<request_id>')
+def smart_send_status(request_id):
+    '''Status and dispatch secrets of an asynchronously ingested /smart-send'''
+
+    dispatch_acces_token = flask.request.args.get("dispatch-access-token") or ""
+    if not dispatch_acces_token:
+        dispatch_acces_token = flask.request.headers.get("Dispatcher-Token") or ""
+    if dispatch_acces_token != app.config["DISPATCH_ACCESS_TOKEN"]:
+        return (BAD_DISPATCH_ACCESS_TOKEN, 401)
+
+    intake = db.session.get(IntakeRequest, request_id)
+    if not intake:
+        return ("No such request", 404)
+
+    return flask.jsonify(intake.serialize())
+
+def _resolve_and_enqueue(users, groups, title, message, method, link, commit=True):
+    '''Look up the recipients and queue a dispatch for each, returns the dispatch secrets'''
+
     if method in ["debug", "debug-fail"]:
         persons = [ldaptools.Person(cn="none", username=users[0], name="Mr. Debug",
                         email="invalid@nope.notld", phone="0")]
     else:
-        persons = ldaptools.select_targets(users, groups, app.config["LDAP_ARGS"])
+        persons = _select_targets(users, groups)
 
-    dispatch_secrets = save_in_dispatch_queue(persons, title, message, method, link)
-    return flask.jsonify(dispatch_secrets)
+    return save_in_dispatch_queue(persons, title, message, method, link, commit=commit)
 
+def _claim_intake_request(now):
+    '''Take one pending (or abandoned) intake request, returns it or None'''
 
-def save_in_dispatch_queue(persons, title, message, method, link=""):
+    lease = app.config.get("INTAKE_LEASE_SECONDS") or DEFAULT_INTAKE_LEASE_SECONDS
+    claimable = or_(IntakeRequest.status == "pending",
+                    and_(IntakeRequest.status == "processing",
+                         IntakeRequest.lease_expires_at < now))
 
-    now_str = str(datetime.datetime.now())
-    print(f"Scheduling message to {abs(hash(str(persons)))} @ {now_str}", file=sys.stderr)
+    candidates = db.session.query(IntakeRequest.request_id).filter(claimable).order_by(
+                        IntakeRequest.created_at).limit(10).all()
 
-    dispatch_secrets = []
-    for p in persons:
+    # conditional update, so concurrent workers (also in other processes) never share a request #
+    for (request_id,) in candidates:
+        claimed = db.session.query(IntakeRequest).filter(
+                        IntakeRequest.request_id == request_id, claimable).update({
+                            "status" : "processing",
+                            "lease_expires_at" : now + lease,
+                            "attempts" : func.coalesce(IntakeRequest.attempts, 0) + 1,
+                        }, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return db.session.get(IntakeRequest, request_id)
 
-        if not p:
+    return None
+
+def _process_intake_request(intake):
+
+    lease_expires_at = intake.lease_expires_at
+    still_ours = and_(IntakeRequest.request_id == intake.request_id,
+                      IntakeRequest.status == "processing",
+                      IntakeRequest.lease_expires_at == lease_expires_at)
+
+    try:
+        dispatch_secrets = _resolve_and_enqueue(json.loads(intake.users), json.loads(intake.groups),
+                                intake.title, intake.message, intake.method, intake.link,
+                                commit=False)
+    except Exception as e:
+        db.session.rollback()
+        print("Intake {} failed: {}".format(intake.request_id, e), file=sys.stderr)
+
+        # retried through the lease with backoff, given up after MAX_DISPATCH_ATTEMPTS #
+        attempts = intake.attempts or 1
+        if attempts >= (app.config.get("MAX_DISPATCH_ATTEMPTS") or DEFAULT_MAX_ATTEMPTS):
+            update = { "status" : "failed", "error" : str(e) }
+        else:
+            update = { "lease_expires_at" : time.time() + _retry_delay(attempts), "error" : str(e) }
+
+        db.session.query(IntakeRequest).filter(still_ours).update(update, synchronize_session=False)
+        db.session.commit()
+        return
+
+    # dispatches and intake status in one transaction, unless the request was reclaimed #
+    done = db.session.query(IntakeRequest).filter(still_ours).update({
+                    "status" : "done",
+                    "error" : None,
+                    "dispatch_secrets" : json.dumps(dispatch_secrets),
+                }, synchronize_session=False)
+
+    if not done:
+        db.session.rollback()
+        print("Intake {} was reclaimed, dropping result".format(intake.request_id), file=sys.stderr)
+        return
+
+    _commit_enqueue()
+
+def _intake_worker_loop():
+
+    version = intake_notifier.version
+    while True:
+
+        with app.app_context():
+            try:
+                intake = _claim_intake_request(time.time())
+                if intake:
+                    _process_intake_request(intake)
+                    continue
+
+                # nothing to do, clean up old results #
+                retention = app.config.get("INTAKE_RETENTION_SECONDS") or DEFAULT_INTAKE_RETENTION_SECONDS
+                db.session.query(IntakeRequest).filter(
+                        IntakeRequest.status.in_(["done", "failed"]),
+                        IntakeRequest.created_at < time.time() - retention).delete(
+                        synchronize_session=False)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print("Intake worker error: {}".format(e), file=sys.stderr)
+            finally:
+                db.session.remove()
+
+        # requests from other processes and retries are picked up by the timeout #
+        version = intake_notifier.wait(version, 5)
+
+
+def _insert_dispatch_objects_statement():
+    '''Build an INSERT that upserts instead of merge's read-before-write where supported'''
+
+    table = DispatchObject.__table__
+    dialect = db.engine.dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return table.insert()
+
+    return insert(table).on_conflict_do_nothing(index_elements=["dispatch_secret"])
+
+def _digest_line(title, message):
+    '''One line summary of a message for digests'''
+
+    if title:
+        return title
+
+    return (message or "").strip().split("\n")[0]
+
+def _coalesce_into_pending(rows, now):
+    '''Merge rows into pending dispatches of the same user and method within the window
+
+    Merged rows take over the dispatch secret of the digest they were merged into,
+    returns the rows that still have to be inserted.
+    '''
+
+    window = app.config.get("COALESCE_WINDOW_SECONDS")
+    max_lines = app.config.get("DIGEST_MAX_LINES") or DEFAULT_DIGEST_MAX_LINES
+
+    # pending = not yet claimed, not failed and still inside the window #
+    pending = db.session.query(DispatchObject).filter(
+                        DispatchObject.username.in_([ r["username"] for r in rows ]),
+                        DispatchObject.method == rows[0]["method"],
+                        DispatchObject.timestamp >= now - window,
+                        DispatchObject.dispatch_error.is_(None),
+                        _lease_available(now)).order_by(DispatchObject.timestamp).all()
+
+    digests = {}
+    for d in pending:
+        digests.setdefault(d.username, d)
+
+    remaining = []
+    for row in rows:
+
+        digest = digests.get(row["username"])
+        if not digest:
+            remaining.append(row)
             continue
 
-        # this secret will be needed to confirm the message as dispatched #
-        dispatch_secret = secrets.token_urlsafe(32)
+        count = digest.coalesced or 1
+        if count > 1:
+            lines = digest.message.split("\n")
+        else:
+            lines = [ "- " + _digest_line(digest.title, digest.message) ]
+
+        # drop the previous "more" marker, list the first <max_lines>, count the rest #
+        if lines and lines[-1].startswith("(+"):
+            lines = lines[:-1]
+        if len(lines) < max_lines:
+            lines.append("- " + _digest_line(row["title"], row["message"]))
+        if count + 1 > len(lines):
+            lines.append("(+{} more)".format(count + 1 - len(lines)))
+
+        # only merge if nobody else merged or claimed in the meantime #
+        merged = db.session.query(DispatchObject).filter(
+                        DispatchObject.id == digest.id,
+                        or_(DispatchObject.coalesced == digest.coalesced,
+                            DispatchObject.coalesced.is_(None)),
+                        _lease_available(now)).update({
+                            "title" : "{} notifications".format(count + 1),
+                            "message" : "\n".join(lines),
+                            "coalesced" : count + 1,
+                        }, synchronize_session=False)
+
+        if merged:
+            row["dispatch_secret"] = digest.dispatch_secret
+        else:
+            remaining.append(row)
+
+    return remaining
+
+def _commit_enqueue():
+    '''Commit queued dispatches and wake up long-polling clients'''
+
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute(text("NOTIFY {}".format(notifier.NOTIFY_CHANNEL)))
+    db.session.commit()
+    queue_notifier.notify()
+
+def save_in_dispatch_queue(persons, title, message, method, link="", commit=True):
+
+    now = datetime.datetime.now()
+    print(f"Scheduling message to {abs(hash(str(persons)))} @ {now}", file=sys.stderr)
+
+    # handle bytes input #
+    def normalize(v):
+        return v.decode("utf-8") if isinstance(v, bytes) else v
+
+    master_method = "any"
 
-        master_method = "any"
+    # substitute once here instead of on every poll #
+    title = _apply_substitution(title)
+    message = _apply_substitution(message)
 
-        # handle bytes input #
-        def normalize(v):
-            return v.decode("utf-8") if isinstance(v, bytes) else v
+    # hold new dispatches for the coalescing window, so an alert storm becomes one digest #
+    window = app.config.get("COALESCE_WINDOW_SECONDS")
+    next_attempt_at = now.timestamp() + window if window else None
+
+    rows = []
+    usernames = set()
+    for p in persons:
+
+        if not p:
+            continue
 
         p.username = normalize(p.username)
         p.phone = normalize(p.phone)
         p.email = normalize(p.email)
 
-        obj = DispatchObject(username=p.username,
+        # same person reached through several groups #
+        if p.username in usernames:
+            continue
+        usernames.add(p.username)
+
+        # this secret will be needed to confirm the message as dispatched #
+        dispatch_secret = secrets.token_urlsafe(32)
+
+        rows.append(dict(username=p.username,
                         phone=p.phone,
                         email=p.email,
                         method=method or master_method,
-                        timestamp=datetime.datetime.now().timestamp(),
+                        timestamp=now.timestamp(),
                         dispatch_secret=dispatch_secret,
                         title=title,
                         link=link,
-                        message=message)
+                        message=message,
+                        next_attempt_at=next_attempt_at))
 
-        db.session.merge(obj)
-        db.session.commit()
+    dispatch_secrets = [ r["dispatch_secret"] for r in rows ]
+
+    new_rows = rows
+    if window and rows:
+        new_rows = _coalesce_into_pending(rows, now.timestamp())
+        dispatch_secrets = [ r["dispatch_secret"] for r in rows ]
 
-        dispatch_secrets.append(dispatch_secret)
+    # whole fan-out in one statement and one transaction #
+    if rows:
+        if new_rows:
+            db.session.execute(_insert_dispatch_objects_statement(), new_rows)
+        if commit:
+            _commit_enqueue()
 
     return dispatch_secrets
 
@@ -432,13 +1381,142 @@ def health():
 
     try:
         db.session.execute(text("SELECT 1"))
-        return ({"status": "ok"}, 200)
     except Exception as e:
         return ({"status": "error", "message": str(e)}, 500)
 
+    status = {"status": "ok"}
+    if app.config.get("LDAP_SNAPSHOT_INTERVAL"):
+        snapshot = get_directory_snapshot_state()
+        last_sync = snapshot.get("last_sync")
+        status["directory_snapshot"] = {
+            "interval" : app.config["LDAP_SNAPSHOT_INTERVAL"],
+            "last_sync" : last_sync and datetime.datetime.fromtimestamp(last_sync).isoformat(),
+            "staleness" : last_sync and int(time.time() - last_sync),
+            "error" : snapshot.get("last_error"),
+        }
+
+    return (status, 200)
+
+@app.route("/metrics")
+def prometheus_metrics():
+
+    now = time.time()
+    state = case((DispatchObject.dispatch_error.is_not(None), "error"),
+                 (DispatchObject.lease_expires_at > now, "leased"),
+                 else_="pending")
+
+    depths = db.session.query(DispatchObject.method, state, func.count()).group_by(
+                        DispatchObject.method, state).all()
+    oldest = db.session.query(func.min(DispatchObject.timestamp)).filter(
+                        DispatchObject.dispatch_error.is_(None)).scalar()
+
+    metrics.set_queue_state({ (method or "any", s) : count for method, s, count in depths },
+                        oldest and now - oldest)
+
+    body, content_type = metrics.render()
+    return flask.Response(body, content_type=content_type)
+
+@app.before_request
+def _start_request_timer():
+    flask.g.request_started = time.monotonic()
+
+@app.after_request
+def _observe_request_latency(response):
+
+    started = flask.g.get("request_started")
+    if started is not None:
+
+        # route template, not the path, to keep webhook secrets out of the labels #
+        rule = flask.request.url_rule
+        metrics.REQUEST_SECONDS.labels(route=rule.rule if rule else "unmatched",
+                        method=flask.request.method,
+                        status=response.status_code).observe(time.monotonic() - started)
+
+    return response
+
+@contextlib.contextmanager
+def _schema_lock():
+    '''Serialize schema migrations of workers starting at the same time
+
+    Only implemented for postgres (advisory lock), with sqlite the first start
+    after an upgrade must be a single process.
+    '''
+
+    if db.engine.dialect.name != "postgresql":
+        yield
+        return
+
+    with db.engine.connect() as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:id)"), { "id" : SCHEMA_LOCK_ID })
+        conn.commit()
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:id)"), { "id" : SCHEMA_LOCK_ID })
+            conn.commit()
+
+def _migrate_dispatch_queue():
+    '''Rebuild a dispatch_queue table from before the surrogate key was introduced'''
+
+    table = DispatchObject.__tablename__
+    inspector = sqlalchemy.inspect(db.engine)
+    if not inspector.has_table(table):
+        return
+
+    legacy_columns = [ c["name"] for c in inspector.get_columns(table) ]
+    if "id" in legacy_columns:
+        return
+
+    print("Migrating {} to surrogate key schema".format(table), file=sys.stderr)
+
+    legacy_table = table + "_legacy"
+    columns = ", ".join([ c for c in legacy_columns if c in DispatchObject.__table__.columns ])
+    with db.engine.begin() as conn:
+
+        conn.execute(text("ALTER TABLE {} RENAME TO {}".format(table, legacy_table)))
+
+        # postgres keeps the old constraint name, which would clash #
+        if db.engine.dialect.name == "postgresql":
+            conn.execute(text("ALTER TABLE {} DROP CONSTRAINT IF EXISTS {}_pkey".format(
+                                legacy_table, table)))
+
+        DispatchObject.__table__.create(conn)
+        conn.execute(text("INSERT INTO {table} ({columns}) SELECT {columns} FROM {legacy} "
+                          "ORDER BY timestamp".format(table=table, columns=columns,
+                                                      legacy=legacy_table)))
+        conn.execute(text("DROP TABLE {}".format(legacy_table)))
+
+def _add_missing_columns():
+    '''Add nullable columns introduced after a table was first created'''
+
+    inspector = sqlalchemy.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+
+        if not inspector.has_table(table.name):
+            continue
+
+        existing = [ c["name"] for c in inspector.get_columns(table.name) ]
+        for column in table.columns:
+            if column.name in existing:
+                continue
+
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            print("Adding column {}.{}".format(table.name, column.name), file=sys.stderr)
+            with db.engine.begin() as conn:
+                conn.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(
+                                    table.name, column.name, column_type)))
+
 def create_app():
 
-    db.create_all()
+    # the losers of a migration race would crash on the renamed/added tables & columns #
+    with _schema_lock():
+        _migrate_dispatch_queue()
+        _add_missing_columns()
+        db.create_all()
+
+    # wake long-polls for enqueues in other worker processes #
+    if db.engine.dialect.name == "postgresql":
+        queue_notifier.listen_postgres(db.engine)
 
     app.config["LDAP_NO_READ_ENV"] = os.environ.get("LDAP_NO_READ_ENV") or app.config.get("LDAP_NO_READ_ENV")
     if not app.config.get("LDAP_NO_READ_ENV"):
@@ -446,10 +1524,16 @@ def create_app():
             "LDAP_SERVER"  : os.environ["LDAP_SERVER"],
             "LDAP_BIND_DN" : os.environ["LDAP_BIND_DN"],
             "LDAP_BIND_PW" : os.environ["LDAP_BIND_PW"],
-            "LDAP_BASE_DN" : os.environ["LDAP_BASE_DN"]
+            "LDAP_BASE_DN" : os.environ["LDAP_BASE_DN"],
+            "LDAP_POOL_SIZE" : os.environ.get("LDAP_POOL_SIZE"),
+            "LDAP_POOL_IDLE_TIMEOUT" : os.environ.get("LDAP_POOL_IDLE_TIMEOUT"),
+            "LDAP_TIMEOUT" : os.environ.get("LDAP_TIMEOUT"),
         }
         app.config["LDAP_ARGS"] = ldap_args
 
+    ldaptools.configure_cache(ttl=os.environ.get("LDAP_CACHE_TTL"),
+                              max_size=os.environ.get("LDAP_CACHE_SIZE"))
+
     app.config["SETTINGS_ACCESS_TOKEN"] = os.environ["SETTINGS_ACCESS_TOKEN"]
     app.config["DISPATCH_ACCESS_TOKEN"] = os.environ["DISPATCH_ACCESS_TOKEN"]
 
@@ -459,10 +1543,55 @@ def create_app():
         with open(substitution_config_file) as f:
             app.config["SUBSTITUTIONS"] = yaml.safe_load(f) or {}
 
+    app.config["SUBSTITUTION_PATTERN"] = _compile_substitutions(app.config["SUBSTITUTIONS"])
     print("Loaded subs:", substitution_config_file, app.config["SUBSTITUTIONS"], file=sys.stderr)
 
-    # set small downtime #
-    app.config["DOWNTIME"] = datetime.datetime.now() + datetime.timedelta(minutes=1)
+    # optionally resolve recipients from a periodically synced local directory #
+    snapshot_interval = os.environ.get("LDAP_SNAPSHOT_INTERVAL")
+    if snapshot_interval and app.config.get("LDAP_ARGS"):
+        app.config["LDAP_SNAPSHOT_INTERVAL"] = int(snapshot_interval)
+        threading.Thread(target=_directory_sync_loop, args=(int(snapshot_interval),),
+                            daemon=True).start()
+
+    # concurrent waiting long-polls, keep this well below the server's thread count #
+    global long_poll_slots
+    long_poll_slots = threading.BoundedSemaphore(int(os.environ.get("MAX_LONG_POLLS")
+                                                or DEFAULT_MAX_LONG_POLLS))
+
+    # acknowledge /smart-send immediately and resolve recipients in background workers #
+    app.config["ASYNC_INGEST"] = os.environ.get("ASYNC_INGEST", "").lower() in ("1", "true", "yes")
+    app.config["INTAKE_LEASE_SECONDS"] = int(os.environ.get("INTAKE_LEASE_SECONDS")
+                                                or DEFAULT_INTAKE_LEASE_SECONDS)
+    app.config["INTAKE_RETENTION_SECONDS"] = int(os.environ.get("INTAKE_RETENTION_SECONDS")
+                                                or DEFAULT_INTAKE_RETENTION_SECONDS)
+    if app.config["ASYNC_INGEST"]:
+        for _ in range(int(os.environ.get("INTAKE_WORKERS") or DEFAULT_INTAKE_WORKERS)):
+            threading.Thread(target=_intake_worker_loop, daemon=True).start()
+
+    # merge messages for the same user & method arriving within this window (0 disables) #
+    app.config["COALESCE_WINDOW_SECONDS"] = int(os.environ.get("COALESCE_WINDOW_SECONDS") or 0)
+    app.config["DIGEST_MAX_LINES"] = int(os.environ.get("DIGEST_MAX_LINES")
+                                                or DEFAULT_DIGEST_MAX_LINES)
+
+    # retry schedule for failed dispatches #
+    app.config["MAX_DISPATCH_ATTEMPTS"] = int(os.environ.get("MAX_DISPATCH_ATTEMPTS")
+                                                or DEFAULT_MAX_ATTEMPTS)
+    app.config["RETRY_BACKOFF_BASE"] = int(os.environ.get("RETRY_BACKOFF_BASE")
+                                                or DEFAULT_RETRY_BACKOFF_BASE)
+    app.config["RETRY_BACKOFF_MAX"] = int(os.environ.get("RETRY_BACKOFF_MAX")
+                                                or DEFAULT_RETRY_BACKOFF_MAX)
+
+    # shared state (downtime, webhook version) is cached per process for this long #
+    app.config["SHARED_STATE_REFRESH_SECONDS"] = float(os.environ.get("SHARED_STATE_REFRESH_SECONDS")
+                                                or DEFAULT_SHARED_STATE_REFRESH_SECONDS)
+
+    # set small downtime on the very first start only, restarting or adding a worker #
+    # must not touch the downtime (or its absence) every other worker is using      #
+    if get_shared_state("downtime") is None:
+        set_downtime(datetime.datetime.now() + datetime.timedelta(minutes=1))
+
+    # webhook paths are authenticated from memory #
+    _load_webhook_index()
 
 if __name__ == "__main__":
 
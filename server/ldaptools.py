@@ -1,5 +1,20 @@
+import collections
 import ldap
+import ldap.filter
+import metrics
 import sys
+import threading
+import time
+
+LDAP_POOL_SIZE = 4
+LDAP_POOL_IDLE_TIMEOUT = 300
+LDAP_TIMEOUT = 10
+LDAP_BATCH_SIZE = 100
+LDAP_CACHE_TTL = 300
+LDAP_CACHE_SIZE = 10000
+
+_pools = {}
+_pools_lock = threading.Lock()
 
 class Person:
 
@@ -17,28 +32,204 @@ class Person:
     def __hash__(self):
         return hash(self.cn)
 
-def ldap_query(search_filter, ldap_args, alt_base_dn=None):
+class LdapConnectionPool:
+    '''Thread-safe pool of bound LDAP connections shared across requests'''
+
+    def __init__(self, server, bind_dn, bind_pw, size=LDAP_POOL_SIZE,
+                    idle_timeout=LDAP_POOL_IDLE_TIMEOUT, timeout=LDAP_TIMEOUT):
+
+        self.server = server
+        self.bind_dn = bind_dn
+        self.bind_pw = bind_pw
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        self._idle = [] # (connection, last_used) #
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+
+        # never hang on an unresponsive server, a timeout lets the stale cache take over #
+        conn = ldap.initialize(self.server)
+        conn.set_option(ldap.OPT_NETWORK_TIMEOUT, self.timeout)
+        conn.set_option(ldap.OPT_TIMEOUT, self.timeout)
+        conn.simple_bind_s(self.bind_dn, self.bind_pw)
+        return conn
+
+    def _close(self, conn):
+
+        try:
+            conn.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def _acquire(self):
+
+        # all connections busy for this long means the server is most likely stuck #
+        if not self._slots.acquire(timeout=self.timeout):
+            raise ldap.SERVER_DOWN("No LDAP connection available after {}s".format(self.timeout))
+
+        try:
+            with self._lock:
+                while self._idle:
+                    conn, last_used = self._idle.pop()
+                    if time.time() - last_used > self.idle_timeout:
+                        self._close(conn)
+                        continue
+                    return conn
+            return self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, conn, broken=False):
+
+        if broken:
+            self._close(conn)
+        else:
+            with self._lock:
+                self._idle.append((conn, time.time()))
+
+        self._slots.release()
+
+    def search(self, base_dn, search_scope, search_filter, attrlist=None):
+
+        conn = self._acquire()
+        try:
+            try:
+                results = conn.search_s(base_dn, search_scope, search_filter, attrlist)
+            except ldap.SERVER_DOWN:
+                # pooled connection went stale, rebind once and retry #
+                print("WARNING: LDAP connection lost, rebinding", file=sys.stderr)
+                self._close(conn)
+                conn = self._connect()
+                results = conn.search_s(base_dn, search_scope, search_filter, attrlist)
+        except Exception:
+            self._release(conn, broken=True)
+            raise
+
+        self._release(conn)
+        return results
+
+    def close(self):
+
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for conn, _ in idle:
+            self._close(conn)
+
+class TTLCache:
+    '''Thread-safe LRU cache with per-entry TTL, keeps expired entries as stale fallback'''
+
+    def __init__(self, ttl=LDAP_CACHE_TTL, max_size=LDAP_CACHE_SIZE):
+
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self._entries = collections.OrderedDict() # key -> (value, stored_at) #
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+
+    def get(self, key, allow_stale=False):
+
+        with self._lock:
+
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, stored_at = entry
+            expired = time.time() - stored_at > self.ttl
+            if expired and not allow_stale:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            if expired:
+                self.stale_hits += 1
+            else:
+                self.hits += 1
+
+            return value
+
+    def set(self, key, value):
+
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+
+        with self._lock:
+            return {
+                "size" : len(self._entries),
+                "max_size" : self.max_size,
+                "ttl" : self.ttl,
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "stale_hits" : self.stale_hits,
+            }
+
+cache = TTLCache()
+
+def configure_cache(ttl=None, max_size=None):
+
+    if ttl is not None:
+        cache.ttl = int(ttl)
+    if max_size is not None:
+        cache.max_size = int(max_size)
+
+def get_pool(ldap_args):
+    '''Return the connection pool for the server/bind-dn in ldap_args'''
+
+    key = (ldap_args["LDAP_SERVER"], ldap_args["LDAP_BIND_DN"])
+    with _pools_lock:
+        pool = _pools.get(key)
+        if not pool:
+            pool = LdapConnectionPool(ldap_args["LDAP_SERVER"],
+                            ldap_args["LDAP_BIND_DN"],
+                            ldap_args["LDAP_BIND_PW"],
+                            size=int(ldap_args.get("LDAP_POOL_SIZE") or LDAP_POOL_SIZE),
+                            idle_timeout=int(ldap_args.get("LDAP_POOL_IDLE_TIMEOUT")
+                                                or LDAP_POOL_IDLE_TIMEOUT),
+                            timeout=float(ldap_args.get("LDAP_TIMEOUT") or LDAP_TIMEOUT))
+            _pools[key] = pool
+        return pool
+
+def ldap_query(search_filter, ldap_args, alt_base_dn=None, attrlist=None):
     
-    ldap_server = ldap_args["LDAP_SERVER"]
-    manager_dn = ldap_args["LDAP_BIND_DN"]
-    manager_pw = ldap_args["LDAP_BIND_PW"]
     base_dn = ldap_args["LDAP_BASE_DN"]
 
     # for example a specific user dn #
     if alt_base_dn:
         base_dn = alt_base_dn
 
-    # estabilish connection
-    conn = ldap.initialize(ldap_server)
-    conn.simple_bind_s(manager_dn, manager_pw)
-
-    # search in scope #
+    # search in scope on a pooled connection #
     search_scope = ldap.SCOPE_SUBTREE
-    search_results = conn.search_s(base_dn, search_scope, search_filter)
-   
-    # unbind from connection and return #
-    conn.unbind_s()
-    return search_results
+    started = time.monotonic()
+    try:
+        result = get_pool(ldap_args).search(base_dn, search_scope, search_filter, attrlist)
+    except ldap.LDAPError:
+        metrics.LDAP_QUERIES.labels(result="error").inc()
+        raise
+    finally:
+        metrics.LDAP_QUERY_SECONDS.observe(time.monotonic() - started)
+
+    metrics.LDAP_QUERIES.labels(result="ok").inc()
+    return result
 
 def _person_from_search_result(cn, entry):
 
@@ -49,6 +240,9 @@ def _person_from_search_result(cn, entry):
 
     return Person(cn, username, name, email, phone)
 
+def _uid_from_dn(dn):
+    return dn.split(",")[0].split("=")[1]
+
 def get_user_by_uid(username, ldap_args, uid_is_cn=False):
 
     if not username:
@@ -56,7 +250,7 @@ def get_user_by_uid(username, ldap_args, uid_is_cn=False):
         return None
 
     if uid_is_cn:
-        username = username.split(",")[0].split("=")[1]
+        username = _uid_from_dn(username)
 
     search_filter = "(&(objectClass=inetOrgPerson)(uid={username}))".format(username=username)
     results = ldap_query(search_filter, ldap_args)
@@ -69,17 +263,80 @@ def get_user_by_uid(username, ldap_args, uid_is_cn=False):
     return _person_from_search_result(cn, p)
 
 
-def get_members_of_group(group, ldap_args):
+def _search_users_by_uid(usernames, ldap_args):
 
-    if not group:
+    persons = []
+    for i in range(0, len(usernames), LDAP_BATCH_SIZE):
+
+        chunk = usernames[i:i+LDAP_BATCH_SIZE]
+        uid_filter = "".join([ "(uid={})".format(ldap.filter.escape_filter_chars(u)) for u in chunk ])
+        search_filter = "(&(objectClass=inetOrgPerson)(|{}))".format(uid_filter)
+
+        for cn, entry in ldap_query(search_filter, ldap_args) or []:
+            if cn is None: # search references #
+                continue
+            persons.append(_person_from_search_result(cn, entry))
+
+    return persons
+
+def get_users_by_uid(usernames, ldap_args):
+    '''Resolve many usernames with one (|(uid=a)(uid=b)...) search per chunk'''
+
+    usernames = list(dict.fromkeys([ u for u in usernames if u ]))
+    if not usernames:
         return []
 
-    search_filter = "(&(objectClass=groupOfNames)(cn={group_name}))".format(group_name=group)
+    # serve what we can from the cache #
+    persons = []
+    missing = []
+    for username in usernames:
+        person = cache.get(("uid", username))
+        if person:
+            persons.append(person)
+        else:
+            missing.append(username)
+
+    if not missing:
+        return persons
+
+    try:
+        found = _search_users_by_uid(missing, ldap_args)
+    except ldap.LDAPError as e:
+
+        # directory outage, fall back to expired entries #
+        stale = [ cache.get(("uid", u), allow_stale=True) for u in missing ]
+        stale = [ p for p in stale if p ]
+        if not stale and not persons:
+            raise
+
+        print("WARNING: LDAP unavailable ({}), using {} stale entries".format(e, len(stale)),
+                file=sys.stderr)
+        return persons + stale
+
+    found_usernames = set()
+    for person in found:
+        username = person.username
+        if isinstance(username, bytes):
+            username = username.decode("utf-8")
+        cache.set(("uid", username), person)
+        found_usernames.add(username)
+
+    for username in missing:
+        if username not in found_usernames:
+            print("WARNING: {} not found, no dispatch saved".format(username), file=sys.stderr)
+
+    return persons + found
+
+def _groups_base_dn(ldap_args):
 
     # TODO wtf is this btw??
     base_dn = ldap_args["LDAP_BASE_DN"]
-    groups_dn = ",".join([ s.replace("People","groups") for s in base_dn.split(",")])
-    results = ldap_query(search_filter, ldap_args, alt_base_dn=groups_dn)
+    return ",".join([ s.replace("People","groups") for s in base_dn.split(",")])
+
+def _search_group_member_uids(group, ldap_args):
+
+    search_filter = "(&(objectClass=groupOfNames)(cn={group_name}))".format(group_name=group)
+    results = ldap_query(search_filter, ldap_args, alt_base_dn=_groups_base_dn(ldap_args))
 
     if not results:
         return []
@@ -87,18 +344,26 @@ def get_members_of_group(group, ldap_args):
     group_dn, entry = results[0]
     members = entry.get("member", [])
 
-    persons = []
-    for member in members:
+    return [ _uid_from_dn(member.decode("utf-8")) for member in members ]
 
-        user_cn = member.decode("utf-8")
-        person_obj = get_user_by_uid(user_cn, ldap_args, uid_is_cn=True)
+def get_members_of_group(group, ldap_args):
 
-        if not person_obj:
-            continue
+    if not group:
+        return []
 
-        persons.append(person_obj)
+    usernames = cache.get(("group", group))
+    if usernames is None:
+        try:
+            usernames = _search_group_member_uids(group, ldap_args)
+            cache.set(("group", group), usernames)
+        except ldap.LDAPError as e:
+            usernames = cache.get(("group", group), allow_stale=True)
+            if usernames is None:
+                raise
+            print("WARNING: LDAP unavailable ({}), using stale members of {}".format(e, group),
+                    file=sys.stderr)
 
-    return persons
+    return get_users_by_uid(usernames, ldap_args)
 
 
 def select_targets(users, groups, ldap_args, admin_group="pki"):
@@ -107,8 +372,7 @@ def select_targets(users, groups, ldap_args, admin_group="pki"):
     persons = []
     # FIXME better handling of empty owner/groups
     if users and not any([ not s for s in users]):
-        for username in users:
-            persons.append(get_user_by_uid(username, ldap_args))
+        persons += get_users_by_uid(users, ldap_args)
     elif groups and not any([ not s for s in groups ]):
         for group in groups:
             persons += get_members_of_group(group, ldap_args)
@@ -117,3 +381,60 @@ def select_targets(users, groups, ldap_args, admin_group="pki"):
         persons += get_members_of_group(admin_group, ldap_args)
 
     return set(persons)
+
+def _modified_since_filter(object_class, modified_since):
+
+    if modified_since:
+        return "(&(objectClass={})(modifyTimestamp>={}))".format(object_class, modified_since)
+    else:
+        return "(objectClass={})".format(object_class)
+
+def _max_modify_timestamp(results, watermark):
+
+    for dn, entry in results:
+        ts = entry.get("modifyTimestamp", [None])[0]
+        if ts:
+            ts = ts.decode("utf-8")
+            if not watermark or ts > watermark:
+                watermark = ts
+
+    return watermark
+
+def search_persons(ldap_args, modified_since=None):
+    '''Return all persons (modified since a generalized-time watermark) and the new watermark'''
+
+    search_filter = _modified_since_filter("inetOrgPerson", modified_since)
+    results = ldap_query(search_filter, ldap_args, attrlist=["*", "modifyTimestamp"]) or []
+    results = [ (dn, entry) for dn, entry in results if dn ]
+
+    persons = [ _person_from_search_result(dn, entry) for dn, entry in results ]
+    return persons, _max_modify_timestamp(results, modified_since)
+
+def search_person_dns(ldap_args):
+    '''Return the DNs of all persons, without fetching any attributes'''
+
+    results = ldap_query("(objectClass=inetOrgPerson)", ldap_args, attrlist=["1.1"]) or []
+    return set([ dn for dn, _ in results if dn ])
+
+def search_groups(ldap_args, modified_since=None):
+    '''Return {group: [member uids]} (modified since a watermark) and the new watermark'''
+
+    search_filter = _modified_since_filter("groupOfNames", modified_since)
+    results = ldap_query(search_filter, ldap_args, alt_base_dn=_groups_base_dn(ldap_args),
+                            attrlist=["cn", "member", "modifyTimestamp"]) or []
+    results = [ (dn, entry) for dn, entry in results if dn ]
+
+    groups = {}
+    for dn, entry in results:
+        group = entry.get("cn", [b""])[0].decode("utf-8")
+        members = entry.get("member", [])
+        groups[group] = [ _uid_from_dn(member.decode("utf-8")) for member in members ]
+
+    return groups, _max_modify_timestamp(results, modified_since)
+
+def search_group_names(ldap_args):
+    '''Return the names of all groups'''
+
+    results = ldap_query("(objectClass=groupOfNames)", ldap_args,
+                            alt_base_dn=_groups_base_dn(ldap_args), attrlist=["cn"]) or []
+    return set([ entry.get("cn", [b""])[0].decode("utf-8") for dn, entry in results if dn ])
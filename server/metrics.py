@@ -0,0 +1,34 @@
+import prometheus_client
+
+# HTTP #
+REQUEST_SECONDS = prometheus_client.Histogram("dispatch_http_request_seconds",
+                        "Request latency by route", ["route", "method", "status"])
+
+# LDAP #
+LDAP_QUERIES = prometheus_client.Counter("dispatch_ldap_queries_total",
+                        "LDAP searches sent to the directory", ["result"])
+LDAP_QUERY_SECONDS = prometheus_client.Histogram("dispatch_ldap_query_seconds",
+                        "LDAP search latency")
+
+# queue, gauges are filled from the database on every scrape #
+QUEUE_DEPTH = prometheus_client.Gauge("dispatch_queue_depth",
+                        "Dispatches in the queue", ["method", "state"])
+OLDEST_PENDING_SECONDS = prometheus_client.Gauge("dispatch_queue_oldest_pending_seconds",
+                        "Age of the oldest dispatch without an error")
+ENQUEUE_TO_CONFIRM_SECONDS = prometheus_client.Histogram("dispatch_enqueue_to_confirm_seconds",
+                        "Time from enqueue to confirmation by a client",
+                        buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, float("inf")))
+
+def set_queue_state(depths, oldest_pending_age):
+    '''Replace the queue gauges, depths is { (method, state) : count }'''
+
+    QUEUE_DEPTH.clear()
+    for (method, state), count in depths.items():
+        QUEUE_DEPTH.labels(method=method, state=state).set(count)
+
+    OLDEST_PENDING_SECONDS.set(oldest_pending_age or 0)
+
+def render():
+    '''Return (body, content type) in the prometheus text format'''
+
+    return (prometheus_client.generate_latest(), prometheus_client.CONTENT_TYPE_LATEST)
@@ -0,0 +1,57 @@
+import select
+import sys
+import threading
+import time
+
+NOTIFY_CHANNEL = "dispatch_queue"
+
+class QueueNotifier:
+    '''Wakes up long-polling requests when new dispatches are enqueued'''
+
+    def __init__(self):
+
+        self.version = 0
+        self._condition = threading.Condition()
+
+    def notify(self):
+
+        with self._condition:
+            self.version += 1
+            self._condition.notify_all()
+
+    def wait(self, version, timeout):
+        '''Block until something was enqueued after <version> or timeout, return new version'''
+
+        with self._condition:
+            self._condition.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def listen_postgres(self, engine, channel=NOTIFY_CHANNEL):
+        '''Forward postgres NOTIFYs from other processes to the local waiters'''
+
+        threading.Thread(target=self._postgres_listen_loop, args=(engine, channel),
+                            daemon=True).start()
+
+    def _postgres_listen_loop(self, engine, channel):
+
+        while True:
+            try:
+                conn = engine.raw_connection()
+                try:
+                    dbapi_conn = conn.dbapi_connection
+                    dbapi_conn.autocommit = True
+                    dbapi_conn.cursor().execute("LISTEN {}".format(channel))
+
+                    while True:
+                        if select.select([dbapi_conn], [], [], 60) == ([], [], []):
+                            continue
+                        dbapi_conn.poll()
+                        if dbapi_conn.notifies:
+                            dbapi_conn.notifies.clear()
+                            self.notify()
+                finally:
+                    # don't return an autocommit LISTEN connection to the pool #
+                    conn.invalidate()
+            except Exception as e:
+                print("Postgres LISTEN failed ({}), retrying".format(e), file=sys.stderr)
+                time.sleep(5)
@@ -7,9 +7,18 @@ import subprocess
 import os
 import requests
 from functools import wraps
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 HTTP_NOT_FOUND = 404
 
+# one keep-alive session for all requests to the dispatch server #
+HTTP_SESSION = requests.Session()
+HTTP_ADAPTER = HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.5, allowed_methods=None,
+                                status_forcelist=[502, 503, 504]))
+HTTP_SESSION.mount("http://", HTTP_ADAPTER)
+HTTP_SESSION.mount("https://", HTTP_ADAPTER)
+
 def signal_send(phone, message):
     '''Send message via signal'''
     cmd = [signal_cli_bin, "send", "-m", "'{}'".format(message.replace("'","")), phone]
@@ -24,7 +33,7 @@ def report_dispatch_error(target, uid, error):
 def confirm_dispatch(target, uid):
     '''Confirm to server that message has been dispatched and can be removed'''
 
-    response = requests.post(target + "/confirm-dispatch", json=[{ "uuid" : uid }])
+    response = HTTP_SESSION.post(target + "/confirm-dispatch", json=[{ "uuid" : uid }])
 
     if response.status_code not in [200, 204]:
         print("Failed to confirm disptach with server for {} ({})".format(
@@ -50,7 +59,7 @@ if __name__ == "__main__":
         signal_cli_bin = args.signal_cli_bin
 
     # request dispatches #
-    response = requests.get(args.target +
+    response = HTTP_SESSION.get(args.target +
             "/get-dispatch?method={}&dispatch-access-token={}".format(args.method, args.password))
 
     # check status #